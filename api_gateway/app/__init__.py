@@ -1,23 +1,30 @@
 from flask import Flask
 import redis
 import os
-from flask_jwt_extended import JWTManager
 from app.get_services import register_service, REDIS
+from app.blacklist import BlacklistCache
+from shared.token_cache import TokenVerifier
+from shared import tracing
+from app.response_cache import ResponseCache
+
+tracing.configure("api_gateway")
 
 app = Flask(__name__)
 
 secret_key = os.getenv("JWT_SECRET", "default_value_if_not_set")
 
-app.config['JWT_SECRET_KEY'] = secret_key
-app.config['JWT_COOKIE_SECURE'] = True
-app.config['JWT_TOKEN_LOCATION'] = ['cookies']
-app.config["JWT_COOKIE_CSRF_PROTECT"] = False
 app.secret_key = secret_key
+# Shared with downstream services, which trust the identity the gateway signs with it.
+# Kept apart from JWT_SECRET, without it the services verify the token themselves
+gateway_secret = os.getenv("GATEWAY_SECRET")
 
-jwt = JWTManager(app)
+token_verifier = TokenVerifier(secret_key)
 
 host_name, port = REDIS[0].split(":")
 redis_client = redis.Redis(host=host_name, port=port, db=0, decode_responses=True)
+token_blacklist = BlacklistCache(redis_client)
+
+response_cache = ResponseCache()
 
 port = int(os.getenv("PORT", ""))
 service_name = os.getenv("SERVICE_NAME", "")
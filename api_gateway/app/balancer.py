@@ -0,0 +1,132 @@
+import os
+import random
+import threading
+import time
+
+STRATEGY = os.getenv("GATEWAY_BALANCER", "p2c_ewma")
+EWMA_DECAY = float(os.getenv("GATEWAY_EWMA_DECAY", 0.3))
+EJECT_AFTER_FAILURES = int(os.getenv("GATEWAY_EJECT_AFTER_FAILURES", 5))
+EJECT_SECONDS = float(os.getenv("GATEWAY_EJECT_SECONDS", 30))
+MAX_EJECT_SECONDS = float(os.getenv("GATEWAY_MAX_EJECT_SECONDS", 300))
+# Latency a failed call counts as at least, so an instance that fails fast does not look fast
+FAILURE_PENALTY = float(os.getenv("GATEWAY_FAILURE_PENALTY", 2))
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.in_flight = 0
+        self.ewma_latency = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+    def to_dict(self, now):
+        return {
+            "in_flight": self.in_flight,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 2),
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+            "ejected_for_s": round(max(0.0, self.ejected_until - now), 1),
+        }
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def _get(link):
+    stats = _stats.get(link)
+    if stats is None:
+        stats = _stats.setdefault(link, UpstreamStats())
+    return stats
+
+
+def record_start(link):
+    with _lock:
+        _get(link).in_flight += 1
+
+
+def record_end(link, latency, failed):
+    """Account a finished call; consecutive failures (5xx other than a shedding 503, timeouts,
+    connection errors) eject the instance for a while.
+
+    Ejections get longer each time, until the instance has answered well for
+    MAX_EJECT_SECONDS after its last one.
+    """
+    now = time.monotonic()
+    with _lock:
+        stats = _get(link)
+        stats.in_flight -= 1
+        stats.requests += 1
+        if failed:
+            latency = max(latency, FAILURE_PENALTY)
+        if stats.requests == 1:
+            stats.ewma_latency = latency
+        else:
+            stats.ewma_latency += EWMA_DECAY * (latency - stats.ewma_latency)
+        if not failed:
+            stats.consecutive_failures = 0
+            if stats.ejections and now - stats.ejected_until >= MAX_EJECT_SECONDS:
+                stats.ejections = 0
+            return
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if stats.consecutive_failures >= EJECT_AFTER_FAILURES:
+            stats.ejections += 1
+            stats.consecutive_failures = 0
+            duration = min(EJECT_SECONDS * stats.ejections, MAX_EJECT_SECONDS)
+            stats.ejected_until = now + duration
+
+
+def _random(links):
+    return random.choice(links)
+
+
+def _least_outstanding(links):
+    fewest = min(_get(link).in_flight for link in links)
+    return random.choice([link for link in links if _get(link).in_flight == fewest])
+
+
+def _p2c_ewma(links):
+    if len(links) == 1:
+        return links[0]
+    first, second = random.sample(links, 2)
+
+    def cost(link):
+        stats = _get(link)
+        return stats.ewma_latency * (stats.in_flight + 1)
+
+    return first if cost(first) <= cost(second) else second
+
+
+STRATEGIES = {
+    "random": _random,
+    "least_outstanding": _least_outstanding,
+    "p2c_ewma": _p2c_ewma,
+}
+
+if STRATEGY not in STRATEGIES:
+    raise ValueError(f"Unknown GATEWAY_BALANCER {STRATEGY!r}, expected one of {sorted(STRATEGIES)}")
+
+
+def choose(links, exclude=()):
+    """Pick an instance with the configured strategy.
+
+    Instances in `exclude`, those already tried by a retry, are skipped unless
+    no other is left, then ejected ones unless all are ejected.
+    """
+    now = time.monotonic()
+    links = [link for link in links if link not in exclude] or links
+    with _lock:
+        available = [link for link in links if _get(link).ejected_until <= now] or links
+        return STRATEGIES[STRATEGY](available)
+
+
+def snapshot():
+    now = time.monotonic()
+    with _lock:
+        return {link: stats.to_dict(now) for link, stats in _stats.items()}
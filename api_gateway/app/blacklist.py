@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from shared.blacklist import BLACKLIST_CHANNEL
+
+CACHE_TTL = float(os.getenv("BLACKLIST_CACHE_TTL", 30))
+CACHE_SIZE = int(os.getenv("BLACKLIST_CACHE_SIZE", 10000))
+# Tokens live 30 minutes, a blacklisted one never comes back
+BLACKLISTED_TTL = 30 * 60
+RECONNECT_DELAY = 5
+
+
+class BlacklistCache:
+    """Bounded in-process view of the Redis token blacklist.
+
+    Lookups are cached for CACHE_TTL seconds. Logouts are pushed over Redis
+    pub/sub so a freshly blacklisted token is rejected right away. While the
+    subscription is down, every lookup goes to Redis.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._subscribed = False
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def is_blacklisted(self, key):
+        now = time.monotonic()
+        if self._subscribed:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+        blacklisted = self.redis_client.exists(key) == 1
+        self._store(key, blacklisted, now + (BLACKLISTED_TTL if blacklisted else CACHE_TTL))
+        return blacklisted
+
+    def _store(self, key, blacklisted, expires_at):
+        with self._lock:
+            current = self._entries.get(key)
+            if not blacklisted and current is not None and current[0]:
+                # A logout pushed while Redis was being asked wins over the stale answer
+                return
+            self._entries[key] = (blacklisted, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis_client.pubsub()
+                pubsub.subscribe(BLACKLIST_CHANNEL)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        # Logouts may have been missed while disconnected
+                        with self._lock:
+                            self._entries.clear()
+                        self._subscribed = True
+                    elif message["type"] == "message":
+                        self._store(message["data"], True, time.monotonic() + BLACKLISTED_TTL)
+            except redis.RedisError as exc:
+                print(f"Blacklist subscription failed: {exc}")
+            self._subscribed = False
+            time.sleep(RECONNECT_DELAY)
@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
-from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField
+from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, HiddenField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
 
 
@@ -28,4 +28,5 @@ class NoteForm(FlaskForm):
     
 class UpdateNoteForm(FlaskForm):
     content = TextAreaField('Content', validators=[DataRequired()])
+    version = HiddenField()
     submit = SubmitField('Update')
@@ -1,20 +1,61 @@
 import consul
-import random
+import threading
 import time
+from app import balancer
 consul_client = consul.Consul(host="consul")
 
-def get_service_links_by_name(service_name):
-    services = consul_client.health.service(service_name, passing=True)
+WATCH_WAIT = "30s"
+WATCH_RETRY_DELAY = 5
+
+# Healthy instance links per service, kept current by one watcher thread per service
+_instances = {}
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+def _instance_links(services):
     entries = []
-    for service in services[1]:
+    for service in services:
         service_info = service['Service']
         service_id = service_info['ID']
         port = service_info['Port']
-        entry = f"http://{service_id}:{port}"
-        entries.append(entry)
+        entries.append(f"http://{service_id}:{port}")
+    return entries
+
+def _fetch(service_name, index=None):
+    new_index, services = consul_client.health.service(service_name, passing=True, index=index, wait=WATCH_WAIT)
+    _instances[service_name] = _instance_links(services)
+    return new_index
+
+def _watch(service_name, index):
+    """Long-poll Consul with blocking queries, keeping the last known instances on errors."""
+    while True:
+        try:
+            new_index = _fetch(service_name, index)
+            # Consul asks to restart from zero when the index goes backwards
+            index = new_index if index is None or int(new_index) >= int(index) else None
+        except Exception as exc:
+            print(f"Consul watch for {service_name} failed: {exc}")
+            time.sleep(WATCH_RETRY_DELAY)
+
+def get_service_instances(service_name):
+    if service_name not in _watchers:
+        with _watchers_lock:
+            if service_name not in _watchers:
+                index = None
+                try:
+                    index = _fetch(service_name)
+                except Exception as exc:
+                    print(f"Consul lookup for {service_name} failed: {exc}")
+                watcher = threading.Thread(target=_watch, args=(service_name, index), daemon=True)
+                watcher.start()
+                _watchers[service_name] = watcher
+    return _instances.get(service_name, [])
+
+def get_service_links_by_name(service_name, exclude=()):
+    entries = get_service_instances(service_name)
     if entries == []:
         return None
-    return random.choice(entries)
+    return balancer.choose(entries, exclude)
 
 def get_members(key):
     data = None
@@ -0,0 +1,49 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+CACHE_USERS = int(os.getenv("RESPONSE_CACHE_USERS", 1000))
+CACHE_ENTRIES_PER_USER = int(os.getenv("RESPONSE_CACHE_ENTRIES_PER_USER", 32))
+
+CachedResponse = namedtuple("CachedResponse", ["etag", "data", "headers"])
+
+
+class ResponseCache:
+    """Upstream responses of each user kept with their ETag for revalidation.
+
+    Bounded LRU on both levels: the least recently seen users are dropped
+    first, and each user keeps only their most recent entries. Writes through
+    the gateway drop every entry of the user who made them.
+    """
+
+    def __init__(self, users=CACHE_USERS, entries_per_user=CACHE_ENTRIES_PER_USER):
+        self.users = users
+        self.entries_per_user = entries_per_user
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key):
+        with self._lock:
+            entries = self._entries.get(user_id)
+            if entries is None or key not in entries:
+                return None
+            self._entries.move_to_end(user_id)
+            entries.move_to_end(key)
+            return entries[key]
+
+    def put(self, user_id, key, response):
+        with self._lock:
+            entries = self._entries.get(user_id)
+            if entries is None:
+                entries = self._entries[user_id] = OrderedDict()
+            self._entries.move_to_end(user_id)
+            entries[key] = response
+            entries.move_to_end(key)
+            while len(entries) > self.entries_per_user:
+                entries.popitem(last=False)
+            while len(self._entries) > self.users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
@@ -1,37 +1,101 @@
-from flask import jsonify, request, redirect, url_for, render_template, make_response, abort, g, flash
-from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_request
+import hashlib
+import hmac
+import os
+import time
+from functools import wraps
+import flask
+from flask import jsonify, request, redirect, url_for, make_response, abort, g, flash, Response, \
+    stream_with_context, session
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+import jwt
+import requests
 from app.forms import RegistrationForm, LoginForm, NoteForm, UpdateNoteForm
-from app import app, redis_client, jwt
+from app import app, token_blacklist, token_verifier, gateway_secret, response_cache
+from shared.blacklist import blacklist_key
+from app.response_cache import CachedResponse
 from app.models import CurrentUser
-import random
-from app.get_services import get_service_links_by_name
-import requests
+from app.upstream import call_service, CONNECT_TIMEOUT
+from app import balancer
+from shared.tracing import span
+
+NOTES_PAGE_SIZE = int(os.getenv("NOTES_PAGE_SIZE", 20))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+# notes_service sends a keep-alive every 15 seconds, a stream silent for longer is dead
+CHANGES_READ_TIMEOUT = float(os.getenv("CHANGES_READ_TIMEOUT", 45))
+
+@app.before_request
+def start_trace():
+    """Root span of the request, continuing the trace of the caller when it sent a traceparent."""
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace_span = span(f"{request.method} {route}", request.headers.get("traceparent")).__enter__()
+
+@app.teardown_request
+def end_trace(exc):
+    trace_span = g.pop("trace_span", None)
+    if trace_span is not None:
+        trace_span.__exit__(type(exc) if exc else None, exc, None)
+
+def render_template(template, **context):
+    with span(f"render {template}"):
+        return flask.render_template(template, **context)
 
 @app.before_request
 def load_current_user():
+    """Verify the session token once per request, every later check reads g."""
+    g.current_user = CurrentUser(None)
+    g.jwt_payload = None
+    g.token_expired = False
+    token = request.cookies.get('access_token_cookie')
+    if not token:
+        return
     try:
-        verify_jwt_in_request()
-        identity = get_jwt_identity()
-        g.current_user = CurrentUser(identity)
-    except Exception:
-        g.current_user = CurrentUser(None)
+        with span("jwt verify"):
+            g.jwt_payload = token_verifier.verify(token)
+        g.current_user = CurrentUser(g.jwt_payload.get("sub"))
+    except jwt.ExpiredSignatureError:
+        g.token_expired = True
+    except jwt.InvalidTokenError:
+        pass
 
 @app.before_request
 def check_blacklist():
     """Check if the incoming JWT is blacklisted."""
     token = request.cookies.get('access_token_cookie')
-    if token:
-        if redis_client.get(token):
+    # Only a token that verified can be blacklisted, anonymous requests skip the lookup
+    if token and g.jwt_payload:
+        with span("blacklist check"):
+            blacklisted = token_blacklist.is_blacklisted(blacklist_key(token, g.jwt_payload))
+        if blacklisted:
             return jsonify({"msg": "Token is unavailable"}), 401
 
 @app.context_processor
 def inject_user():
     return dict(current_user=g.get('current_user', None))
 
-@jwt.expired_token_loader
-def custom_expired_token_callback(jwt_header, jwt_payload):
-    flash("Your session expired, login again to continue", "warning")
-    return redirect(url_for('login'))
+def login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.current_user.is_authenticated:
+            return view(*args, **kwargs)
+        if g.token_expired:
+            flash("Your session expired, login again to continue", "warning")
+            return redirect(url_for('login'))
+        return jsonify({"msg": "Missing or invalid access token"}), 401
+    return wrapper
+
+def auth_headers():
+    """Headers that pass the verified identity on, so downstream services do not verify the token again.
+
+    The identity is signed with an HMAC of the user id and the time, the gateway secret itself never leaves.
+    """
+    headers = {"Authorization": f"Bearer {request.cookies.get('access_token_cookie')}"}
+    if gateway_secret:
+        timestamp = str(int(time.time()))
+        signature = hmac.new(gateway_secret.encode(), f"{g.current_user.identity}:{timestamp}".encode(),
+                             hashlib.sha256).hexdigest()
+        headers.update({"X-User-Id": g.current_user.identity, "X-Gateway-Timestamp": timestamp,
+                        "X-Gateway-Signature": signature})
+    return headers
 
 @app.route("/")
 @app.route("/home")
@@ -41,21 +105,16 @@ def home():
 @app.route("/signup", methods=["POST", "GET"])
 def signup():
     """Signup route that handles user registration."""
-    try:
-        verify_jwt_in_request(optional=True)
-        if get_jwt_identity():
-            return redirect(url_for("home"))
-    except Exception:
-        pass
+    if g.current_user.is_authenticated:
+        return redirect(url_for("home"))
     form = RegistrationForm()
     if form.validate_on_submit():
         username = form.username.data
         email = form.email.data
         password = form.password.data
-        selected_service = get_service_links_by_name("auth_service")
-        if selected_service is None:
+        response = call_service("auth_service", "POST", "/signup", params={'username': username, 'email': email, 'password': password})
+        if response is None:
             abort(503)
-        response = requests.post(f'{selected_service}/signup', params={'username': username, 'email': email, 'password': password})
         if response.status_code == 200:
             flash("You registered", "success")
             return redirect(url_for("login"))
@@ -68,20 +127,15 @@ def signup():
 @app.route("/login", methods=["POST", "GET"])
 def login():
     """Login route that handles user authentication."""
-    try:
-        verify_jwt_in_request(optional=True)
-        if get_jwt_identity():
-            return redirect(url_for("home"))
-    except Exception:
-        pass
+    if g.current_user.is_authenticated:
+        return redirect(url_for("home"))
     form = LoginForm()
     if form.validate_on_submit():
         email = form.email.data
         password = form.password.data
-        selected_service = get_service_links_by_name("auth_service")
-        if selected_service is None:
+        response = call_service("auth_service", "POST", "/login", params={'email': email, 'password': password})
+        if response is None:
             abort(503)
-        response = requests.post(f'{selected_service}/login', params={'email': email, 'password': password})
         if response.status_code == 200:
             access_token = response.json().get('access_token')
             response = make_response(redirect(url_for('home')))
@@ -94,18 +148,11 @@ def login():
     return render_template('login.html', title='Login', form=form)
 
 @app.route("/logout", methods=["POST", "GET"])
-@jwt_required()
+@login_required
 def logout():
-    access_token = request.cookies.get('access_token_cookie')
-    if not access_token:
-        return jsonify({"error": "Missing access token cookie"}), 400
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    selected_service = get_service_links_by_name("auth_service")
-    if selected_service is None:
+    response = call_service("auth_service", "POST", "/logout", headers=auth_headers())
+    if response is None:
         abort(503)
-    response = requests.post(f'{selected_service}/logout', headers=headers)
     if response.status_code != 200:
         abort(response.status_code)
     response = make_response(redirect(url_for('home')))
@@ -113,101 +160,155 @@ def logout():
     flash("Logged out successfully", "success")
     return response
 
+def cached_get(path, params=None):
+    """GET from notes_service, revalidating the user's cached copy of the response with If-None-Match."""
+    user_id = g.current_user.identity
+    key = (path, tuple(sorted((params or {}).items())))
+    cached = response_cache.get(user_id, key)
+    headers = auth_headers()
+    if cached is not None:
+        headers["If-None-Match"] = cached.etag
+    response = call_service("notes_service", "GET", path, headers=headers, params=params)
+    if response is None:
+        abort(503)
+    if response.status_code == 304 and cached is not None:
+        return cached
+    if response.status_code != 200:
+        abort(response.status_code)
+    fresh = CachedResponse(response.headers.get("ETag"), response.json(),
+                           {"X-Next-Cursor": response.headers.get("X-Next-Cursor")})
+    if fresh.etag and "X-Read-Stale" not in response.headers:
+        response_cache.put(user_id, key, fresh)
+    return fresh
+
+def render_conditional(cached, template, **context):
+    """Render a page built from an upstream response, 304 when the browser already has this version of it."""
+    if cached.etag is None or session.get("_flashes"):
+        # Flashed messages are shown once, such a page must not be revalidated later
+        return render_template(template, **context)
+    etag = hashlib.sha1(f"{g.current_user.identity}:{template}:{cached.etag}".encode()).hexdigest()[:20]
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render_template(template, **context))
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
 @app.route("/notes", methods = ["GET"])
-@jwt_required()
+@login_required
 def notes():
-    user_id = get_jwt_identity()
-    access_token = request.cookies.get('access_token_cookie')
-    if not access_token:
-        return jsonify({"error": "Missing access token"}), 401
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    selected_service = get_service_links_by_name("notes_service")
-    if selected_service is None:
+    user_id = g.current_user.identity
+    params = {"limit": NOTES_PAGE_SIZE, "view": "summary"}
+    for name in ("after", "min_version"):
+        if request.args.get(name):
+            params[name] = request.args[name]
+    cached = cached_get(f"/users/{user_id}/notes", params)
+    return render_conditional(cached, "notes.html", notes = cached.data, next_cursor = cached.headers["X-Next-Cursor"],
+                              title = "Notes")
+
+@app.route("/notes/changes")
+@login_required
+def note_changes():
+    """Relay the server-sent events announcing changes of the user's notes."""
+    user_id = g.current_user.identity
+    response = call_service("notes_service", "GET", f"/users/{user_id}/notes/changes", headers=auth_headers(),
+                            stream=True, timeout=(CONNECT_TIMEOUT, CHANGES_READ_TIMEOUT))
+    if response is None:
         abort(503)
-    response = requests.get(f"{selected_service}/users/{user_id}/notes", headers=headers)
     if response.status_code != 200:
         abort(response.status_code)
-    notes = response.json()
-    return render_template("notes.html", notes = notes, title = "Notes")
+
+    def relay():
+        try:
+            for chunk in response.iter_content(chunk_size=None):
+                yield chunk
+        except requests.exceptions.RequestException:
+            # The browser reconnects on its own
+            pass
+        finally:
+            response.close()
+
+    return Response(stream_with_context(relay()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/new_note", methods = ["GET", "POST"])
-@jwt_required()
+@login_required
 def new_note():
     form = NoteForm()
     if form.validate_on_submit():
-        user_id = get_jwt_identity()
-        access_token = request.cookies.get('access_token_cookie')
-        headers = {
-            "Authorization": f"Bearer {access_token}"
-        }
-        selected_service = get_service_links_by_name("notes_service")
-        if selected_service is None:
+        user_id = g.current_user.identity
+        response = call_service("notes_service", "POST", "/notes", headers=auth_headers(), json={"user_id": user_id,
+                                                                                                   "title": form.title.data,
+                                                                                                   "content": form.content.data})
+        if response is None:
             abort(503)
-        response = requests.post(f"{selected_service}/notes", headers=headers, json={"user_id": user_id,
-                                                                                       "title": form.title.data,
-                                                                                       "content": form.content.data})
         if response.status_code != 200:
             abort(response.status_code)
+        response_cache.invalidate(user_id)
         flash("Note created", "success")
-        return redirect(url_for("notes"))
+        # The list waits for the new note instead of rendering before the consumer stored it
+        return redirect(url_for("notes", min_version=response.json().get("token")))
     return render_template("create_note.html", form = form, title = "Create Note", legend="Create Note")
 
 @app.route("/view_note/<note_id>", methods = ["GET", "POST"])
-@jwt_required()
+@login_required
 def view_note(note_id):
     form = UpdateNoteForm()
-    access_token = request.cookies.get('access_token_cookie')
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    selected_service = get_service_links_by_name("notes_service")
+    headers = auth_headers()
+    conflict = False
     if form.validate_on_submit():
-        if selected_service is None:
+        params = {"expected_version": form.version.data} if form.version.data else None
+        response = call_service("notes_service", "PUT", f"/notes/{note_id}", headers=headers, params=params,
+                                json={"content": form.content.data})
+        if response is None:
             abort(503)
-        response = requests.put(f"{selected_service}/notes/{note_id}", headers=headers, json={"content": form.content.data})
-        if response.status_code != 200:
-            abort(response.status_code)
-        flash("Note updated", "success")
-        return redirect(url_for("notes"))
-    responce = requests.get(f"{selected_service}/notes/{note_id}", headers=headers)
-    if responce.status_code != 200:
-        abort(responce.status_code)
-    note = responce.json() 
-    form.content.data = note.get("content")
+        response_cache.invalidate(g.current_user.identity)
+        conflict = response.status_code == 409
+        if not conflict:
+            if response.status_code != 200:
+                abort(response.status_code)
+            flash("Note updated", "success")
+            return redirect(url_for("notes", min_version=response.json().get("token")))
+        flash("The note was changed in the meantime, saving again will overwrite it", "warning")
+    # Only revalidated upstream, the page itself carries a CSRF token that must not be served stale
+    note = cached_get(f"/notes/{note_id}").data
+    if not conflict:
+        form.content.data = note.get("content")
+    form.version.data = note.get("version")
     return render_template("view_note.html", form = form, title = "View Note", legend=note.get("title"), note_id = note_id)
 
 @app.route("/remove_note/<note_id>", methods = ["GET", "POST"])
-@jwt_required()
+@login_required
 def remove_note(note_id):
-    access_token = request.cookies.get('access_token_cookie')
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    selected_service = get_service_links_by_name("notes_service")
-    if selected_service is None:
+    response = call_service("notes_service", "DELETE", f"/notes/{note_id}", headers=auth_headers())
+    if response is None:
         abort(503)
-    response = requests.delete(f"{selected_service}/notes/{note_id}", headers=headers)
     if response.status_code != 200:
         abort(response.status_code)
+    response_cache.invalidate(g.current_user.identity)
     flash("Note was deleted", "danger")
-    return redirect(url_for("notes"))
+    return redirect(url_for("notes", min_version=response.json().get("token")))
 
 @app.route("/note_history/<note_id>", methods = ["GET"])
-@jwt_required()
+@login_required
 def note_history(note_id):
-    access_token = request.cookies.get('access_token_cookie')
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    selected_service = get_service_links_by_name("notes_service")
-    if selected_service is None:
-        abort(503)
-    response = requests.get(f"{selected_service}/notes/{note_id}/history", headers=headers)
-    if response.status_code != 200:
-        abort(response.status_code)
-    return render_template("notes_history.html", notes = response.json()['history'])
+    params = {"limit": HISTORY_PAGE_SIZE}
+    if request.args.get("after"):
+        params["after"] = request.args["after"]
+    cached = cached_get(f"/notes/{note_id}/history", params)
+    return render_conditional(cached, "notes_history.html", notes = cached.data['history'], note_id = note_id,
+                              next_cursor = cached.headers["X-Next-Cursor"])
+
+@app.get("/upstreams")
+def upstreams():
+    """Per-instance in-flight, latency and ejection counters of the load balancer."""
+    return jsonify({"strategy": balancer.STRATEGY, "upstreams": balancer.snapshot()})
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics, including the time spent in every traced stage."""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 @app.get("/health")
 def health_check():
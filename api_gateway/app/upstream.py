@@ -0,0 +1,75 @@
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+from app.get_services import get_service_links_by_name
+from app import balancer
+from shared.tracing import span, current_traceparent
+
+CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 2))
+READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 10))
+POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 20))
+RETRIES = int(os.getenv("UPSTREAM_RETRIES", 2))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+RETRY_STATUSES = {502, 503, 504}
+SHED_STATUSES = {503}
+
+# One keep-alive pool per upstream instance, shared by all gateway threads
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=POOL_SIZE, max_retries=0)
+session.mount("http://", adapter)
+session.mount("https://", adapter)
+
+
+def _never_sent(exc):
+    """True when the request failed before reaching the upstream, so any method can be retried."""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = exc.args[0] if exc.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def call_service(service_name, method, path, **kwargs):
+    """Send a request to a healthy instance of a service.
+
+    Failed attempts are retried on another instance: connection failures for
+    any method, timeouts and 502/503/504 only for idempotent methods.
+    Returns None when no instance could answer.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    kwargs["headers"] = dict(kwargs.get("headers") or {})
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    response = None
+    tried = []
+    for _ in range(RETRIES + 1):
+        with span("consul lookup", service=service_name):
+            selected_service = get_service_links_by_name(service_name, exclude=tried)
+        if selected_service is None:
+            return response
+        tried.append(selected_service)
+        balancer.record_start(selected_service)
+        started = time.monotonic()
+        try:
+            with span(f"{service_name} {method}", upstream=selected_service, path=path) as hop:
+                kwargs["headers"]["traceparent"] = current_traceparent()
+                response = session.request(method, f"{selected_service}{path}", **kwargs)
+                hop.tags["status"] = response.status_code
+        except requests.exceptions.ConnectionError as exc:
+            balancer.record_end(selected_service, time.monotonic() - started, failed=True)
+            if _never_sent(exc) or idempotent:
+                continue
+            return None
+        except requests.exceptions.Timeout:
+            balancer.record_end(selected_service, time.monotonic() - started, failed=True)
+            if idempotent:
+                continue
+            return None
+        # A 503 is an instance shedding load on purpose (auth_service sends Retry-After), not an outlier
+        failed = response.status_code >= 500 and response.status_code not in SHED_STATUSES
+        balancer.record_end(selected_service, time.monotonic() - started, failed=failed)
+        if not (idempotent and response.status_code in RETRY_STATUSES):
+            return response
+    return response
@@ -1,17 +1,29 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from shared import tracing
 from app import routes
 from app.database import engine
 from app.models import Base
 from app.get_redis import register_service
+from app.hashing import executor
 import os
 
-Base.metadata.create_all(bind=engine)
-
 port = int(os.getenv("PORT", ""))
 service_name = os.getenv("SERVICE_NAME", "")
 register_service("auth_service", service_name, port)
+tracing.configure("auth_service")
+
+@asynccontextmanager
+async def lifespan(app):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    executor.shutdown(cancel_futures=True)
+    await engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+app.middleware("http")(tracing.asgi_trace_middleware)
 
 
 app.include_router(routes.router)
@@ -1,28 +1,63 @@
 from fastapi import APIRouter, Depends, HTTPException, Header, Response
-from sqlalchemy.orm import Session
-from app.auth_utils import (
-    hash_password, verify_password, create_access_token,
-    blacklist_token)
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.auth_utils import create_access_token, blacklist_token
+from app.hashing import hash_password, verify_password, HashingOverloaded
 from app.models import User
+from app.user_cache import get_user_credentials, cache_user, invalidate_user, is_known_user
 from app.database import get_db
+from shared.tracing import span
 
 router = APIRouter()
 
+def overloaded():
+    return HTTPException(status_code=503, detail="Too many login attempts, try again later",
+                         headers={"Retry-After": "1"})
+
 @router.post("/signup")
-def signup(username: str, email: str, password: str, db: Session = Depends(get_db)):
-    if db.query(User).filter_by(email=email).first():
+async def signup(username: str, email: str, password: str, db: AsyncSession = Depends(get_db)):
+    # Cheap early answer from the cache, the unique index is the real check
+    with span("user lookup"):
+        known = await is_known_user(email)
+    if known:
         raise HTTPException(status_code=400, detail="Email already registered")
-    user = User(username=username, email=email, hashed_password=hash_password(password))
+    try:
+        with span("bcrypt hash"):
+            hashed_password = await hash_password(password)
+    except HashingOverloaded:
+        raise overloaded()
+    user = User(username=username, email=email, hashed_password=hashed_password)
     db.add(user)
-    db.commit()
+    try:
+        with span("postgres insert user"):
+            await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Email already registered")
+    await cache_user({"id": user.id, "email": email, "hashed_password": hashed_password})
     return {"msg": "User created"}
 
 @router.post("/login")
-def login(email: str, password: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter_by(email=email).first()
-    if not user or not verify_password(password, user.hashed_password):
+async def login(email: str, password: str, db: AsyncSession = Depends(get_db)):
+    with span("user lookup"):
+        user = await get_user_credentials(db, email)
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    token = create_access_token({"sub": user.email})
+    try:
+        with span("bcrypt verify"):
+            valid, new_hash = await verify_password(password, user["hashed_password"])
+    except HashingOverloaded:
+        raise overloaded()
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # The bcrypt cost changed since this password was stored
+        await db.execute(update(User).where(User.id == user["id"]).values(hashed_password=new_hash))
+        await db.commit()
+        await invalidate_user(email)
+    token = create_access_token({"sub": user["email"]})
     return {"access_token": token, "token_type": "bearer"}
 
 @router.post("/logout")
@@ -30,10 +65,15 @@ def logout(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=400, detail="Invalid Authorization header")
     token = authorization.replace("Bearer ", "")
-    blacklist_token(token)
+    with span("redis blacklist"):
+        blacklist_token(token)
     return {"msg": "Logged out"}
 
+@router.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @router.get("/health")
 def health_check(response: Response):
     response.status_code = 200
-    return "OK"
\ No newline at end of file
+    return "OK"
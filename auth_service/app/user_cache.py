@@ -0,0 +1,62 @@
+import json
+import os
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from app.get_redis import REDIS_SERVERS
+from app.models import User
+
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 300))
+# Unknown emails are remembered briefly so credential stuffing does not reach Postgres
+NEGATIVE_CACHE_TTL = int(os.getenv("USER_NEGATIVE_CACHE_TTL", 30))
+UNKNOWN_USER = ""
+
+host_name, port = REDIS_SERVERS[0].split(":")
+redis_client = aioredis.Redis(host=host_name, port=port, db=0, decode_responses=True)
+
+def user_key(email: str) -> str:
+    return f"user:{email}"
+
+async def _cache_get(email: str):
+    try:
+        return await redis_client.get(user_key(email))
+    except RedisError:
+        return None
+
+async def _cache_set(email: str, value: str, ttl: int):
+    try:
+        await redis_client.set(user_key(email), value, ex=ttl)
+    except RedisError:
+        pass
+
+async def cache_user(user: dict):
+    await _cache_set(user["email"], json.dumps(user), USER_CACHE_TTL)
+
+async def invalidate_user(email: str):
+    try:
+        await redis_client.delete(user_key(email))
+    except RedisError:
+        pass
+
+async def is_known_user(email: str) -> bool:
+    """True only when the cache already holds the user, never queries Postgres."""
+    cached = await _cache_get(email)
+    return bool(cached)
+
+async def get_user_credentials(db, email: str):
+    """Read-through lookup of id, email and hashed_password, None for unknown emails."""
+    cached = await _cache_get(email)
+    if cached == UNKNOWN_USER:
+        return None
+    if cached is not None:
+        return json.loads(cached)
+
+    row = (await db.execute(
+        select(User.id, User.email, User.hashed_password).where(User.email == email)
+    )).first()
+    if row is None:
+        await _cache_set(email, UNKNOWN_USER, NEGATIVE_CACHE_TTL)
+        return None
+    user = {"id": row.id, "email": row.email, "hashed_password": row.hashed_password}
+    await cache_user(user)
+    return user
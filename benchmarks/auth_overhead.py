@@ -0,0 +1,62 @@
+"""Per-request JWT verification overhead before and after the shared TokenVerifier.
+
+before: the gateway decoded the token twice (load_current_user and
+        @jwt_required) and notes_service decoded it a third time.
+after:  the gateway verifies once through the LRU cache and signs the
+        forwarded identity, notes_service only checks that HMAC.
+
+Usage: python benchmarks/auth_overhead.py --requests 100000
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from shared.token_cache import TokenVerifier  # noqa: E402
+
+SECRET = "benchmark-secret"
+
+
+def before(token):
+    for _ in range(3):
+        jwt.decode(token, SECRET, algorithms=["HS256"])
+
+
+def make_after():
+    verifier = TokenVerifier(SECRET)
+
+    def after(token):
+        claims = verifier.verify(token)
+        message = f"{claims['sub']}:{int(time.time())}".encode()
+        signature = hmac.new(SECRET.encode(), message, hashlib.sha256).hexdigest()
+        hmac.compare_digest(signature, hmac.new(SECRET.encode(), message, hashlib.sha256).hexdigest())
+        return claims["sub"]
+    return after
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    expire = datetime.utcnow() + timedelta(minutes=30)
+    tokens = [jwt.encode({"sub": f"user{i}@example.com", "exp": expire, "jti": str(i)}, SECRET, algorithm="HS256")
+              for i in range(args.users)]
+
+    for name, check in (("before", before), ("after", make_after())):
+        started = time.perf_counter()
+        for i in range(args.requests):
+            check(tokens[i % len(tokens)])
+        elapsed = time.perf_counter() - started
+        print(f"{name:<7} {elapsed / args.requests * 1e6:>8.2f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Throughput and latency of a notes_service read endpoint at increasing client concurrency.
+
+Each client is a thread with its own keep-alive session that requests the
+endpoint in a loop for a fixed duration. Run it once against each build you
+want to compare (e.g. before and after the async rewrite).
+
+Usage: JWT_SECRET=... python benchmarks/concurrent_reads.py --url http://localhost:5011 \\
+           --user user@example.com --clients 50,200,1000 --duration 20
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta
+
+import jwt
+import requests
+
+
+def client(url, headers, deadline, latencies, errors):
+    session = requests.Session()
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(1)
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1] * 1000 if len(values) > 1 else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5011")
+    parser.add_argument("--user", default="bench@example.com")
+    parser.add_argument("--path", default="/users/{user}/notes")
+    parser.add_argument("--clients", default="50,200,1000")
+    parser.add_argument("--duration", type=float, default=20)
+    args = parser.parse_args()
+
+    token = jwt.encode({"sub": args.user, "exp": datetime.utcnow() + timedelta(hours=1)},
+                       os.getenv("JWT_SECRET", "default_value_if_not_set"), algorithm="HS256")
+    headers = {"Authorization": f"Bearer {token}"}
+    url = args.url + args.path.format(user=args.user)
+
+    print(f"{'clients':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for clients in [int(c) for c in args.clients.split(",")]:
+        latencies, errors = [], []
+        deadline = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=client, args=(url, headers, deadline, latencies, errors))
+                   for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"{clients:>7} {len(latencies) / args.duration:>9.1f} {percentile(latencies, 50):>8.1f} "
+              f"{percentile(latencies, 95):>8.1f} {percentile(latencies, 99):>8.1f} {len(errors):>7}")
+
+
+if __name__ == "__main__":
+    main()
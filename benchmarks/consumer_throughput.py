@@ -0,0 +1,90 @@
+"""Throughput of the running event consumer on a synthetic event stream.
+
+Stores versioned note events in the event log the way notes_service does,
+publishes them straight to the partition queues, waits until the consumer has
+folded all of them into notes_current and reports events/sec. The consumer only
+works on notes_db, the synthetic notes belong to their own user and are
+removed afterwards.
+
+Usage: python benchmarks/consumer_throughput.py --rabbit localhost \\
+           --mongo mongodb://localhost:27017/?directConnection=true --notes 100 --updates 20 --partitions 6
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import pika
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service", "app"))
+from publisher import partition_queue  # noqa: E402
+
+USER_ID = "consumer-bench"
+
+
+def synthetic_events(notes, updates):
+    ts = datetime.utcnow()
+    for i in range(notes):
+        note_id = str(uuid4())
+        ts += timedelta(milliseconds=1)
+        yield {"event_id": str(uuid4()), "aggregate_id": note_id, "user_id": USER_ID, "event_type": "NoteCreated",
+               "version": 1, "timestamp": ts, "data": {"title": f"note {i}", "content": ""}}
+        for v in range(updates):
+            ts += timedelta(milliseconds=1)
+            yield {"event_id": str(uuid4()), "aggregate_id": note_id, "user_id": USER_ID, "event_type": "NoteUpdated",
+                   "version": v + 2, "timestamp": ts, "data": {"content": f"version {v}"}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rabbit", default="localhost")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/?directConnection=true")
+    parser.add_argument("--notes", type=int, default=100)
+    parser.add_argument("--updates", type=int, default=20)
+    parser.add_argument("--partitions", type=int, default=6)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["notes_db"]
+    total = args.notes * (args.updates + 1)
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.rabbit))
+    channel = connection.channel()
+    for partition in range(args.partitions):
+        channel.queue_declare(queue=f"note_events.{partition}", durable=True,
+                              arguments={"x-single-active-consumer": True})
+    events = list(synthetic_events(args.notes, args.updates))
+    # notes_service appends every event to the log before publishing it
+    db.events.insert_many([dict(event) for event in events], ordered=False)
+    started = time.perf_counter()
+    for event in events:
+        routing_key = partition_queue("note_events", event["aggregate_id"], args.partitions)
+        channel.basic_publish(exchange='', routing_key=routing_key, body=json.dumps(event, default=str),
+                              properties=pika.BasicProperties(delivery_mode=2))
+    connection.close()
+    published = time.perf_counter()
+
+    applied = 0
+    latest = args.updates + 1
+    while applied < total and time.perf_counter() - started < args.timeout:
+        time.sleep(0.1)
+        applied = sum(note["version"] for note in db.notes_current.find({"user_id": USER_ID}, {"version": 1}))
+    elapsed = time.perf_counter() - started
+    caught_up = db.notes_current.count_documents({"user_id": USER_ID, "version": latest})
+
+    print(f"published {total} events in {published - started:.2f}s")
+    print(f"applied {applied}/{total} events to notes_current in {elapsed:.2f}s: {applied / elapsed:.1f} events/sec")
+    print(f"{caught_up}/{args.notes} notes at their latest version")
+
+    note_ids = db.notes_current.distinct("_id", {"user_id": USER_ID})
+    db.events.delete_many({"user_id": USER_ID})
+    db.notes_current.delete_many({"user_id": USER_ID})
+    db.snapshots.delete_many({"aggregate_id": {"$in": note_ids}})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Storage and replay cost of NoteUpdated events with full content and with deltas.
+
+Builds synthetic edit histories (small inserts, deletions and replacements at
+random places of a large note) and compares the BSON size of the stored events
+and the time to replay them into the final content. Needs no running services.
+
+Usage: python benchmarks/delta_storage.py --size 20000 --edits 500 --checkpoint 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service", "app"))
+from models import NoteAggregate  # noqa: E402
+from shared.delta import make_delta  # noqa: E402
+
+WORDS = ["note", "event", "queue", "replica", "token", "gateway", "snapshot", "delta", "index", "cursor"]
+
+
+def edit(content, rng):
+    position = rng.randrange(len(content) + 1)
+    kind = rng.random()
+    if kind < 0.5:
+        return content[:position] + " " + " ".join(rng.choices(WORDS, k=rng.randint(1, 8))) + content[position:]
+    end = min(len(content), position + rng.randint(1, 40))
+    if kind < 0.8:
+        return content[:position] + content[end:]
+    return content[:position] + rng.choice(WORDS) + content[end:]
+
+
+def history(size, edits, seed):
+    rng = random.Random(seed)
+    content = " ".join(rng.choices(WORDS, k=size // 6))[:size]
+    versions = [content]
+    for _ in range(edits):
+        content = edit(content, rng)
+        versions.append(content)
+    return versions
+
+
+def events(versions, checkpoint):
+    stored = [{"event_type": "NoteCreated", "user_id": "bench", "data": {"title": "bench", "content": versions[0]}}]
+    for version in range(1, len(versions)):
+        content = versions[version]
+        data = {"content": content}
+        if checkpoint and (version + 1) % checkpoint:
+            data = {"delta": make_delta(versions[version - 1], content), "base_version": version}
+        stored.append({"event_type": "NoteUpdated", "user_id": "bench", "data": data})
+    return stored
+
+
+def replay(stored, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        aggregate = NoteAggregate("bench")
+        aggregate.load_from_events([{**event, "data": dict(event["data"])} for event in stored])
+    return aggregate.state["content"], (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20000, help="characters in the note")
+    parser.add_argument("--edits", type=int, default=500)
+    parser.add_argument("--checkpoint", type=int, default=50, help="full content every N versions")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    versions = history(args.size, args.edits, args.seed)
+    print(f"{args.edits} edits of a {args.size} character note")
+    print(f"{'format':<22} {'stored KiB':>12} {'replay ms':>10}")
+    for label, checkpoint in (("full content", 0), (f"delta, checkpoint {args.checkpoint}", args.checkpoint)):
+        started = time.perf_counter()
+        stored = events(versions, checkpoint)
+        encode_ms = (time.perf_counter() - started) * 1000
+        size = sum(len(bson.encode(event)) for event in stored)
+        content, replay_s = replay(stored, args.repeat)
+        if content != versions[-1]:
+            raise SystemExit(f"{label}: replayed content differs from the last version")
+        print(f"{label:<22} {size / 1024:>12.1f} {replay_s * 1000:>10.2f}  (diffing took {encode_ms:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Check with explain() that the hot notes queries are served by an index.
+
+Exits with a non-zero status if any query plan contains a COLLSCAN, or a SORT
+stage, which means the index found the documents but they are sorted in memory.
+
+Usage: python benchmarks/explain_hot_queries.py --mongo mongodb://localhost:27017/?directConnection=true
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service", "app"))
+from pagination import user_aggregates_pipeline  # noqa: E402
+
+
+def plan_stages(plan):
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return [stage for stage in stages if stage]
+
+
+def winning_plan(explain):
+    if "queryPlanner" in explain:
+        return explain["queryPlanner"]["winningPlan"]
+    # aggregate and distinct wrap the planner output in their first stage
+    for stage in explain.get("stages", []):
+        if "$cursor" in stage:
+            return stage["$cursor"]["queryPlanner"]["winningPlan"]
+    raise ValueError("explain output has no query planner section")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/?directConnection=true")
+    parser.add_argument("--db", default="notes_db")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)[args.db]
+    queries = {
+        "events by aggregate sorted by timestamp": db.command(
+            "explain", {"find": "events", "filter": {"aggregate_id": "x"}, "sort": {"timestamp": 1}}),
+        "events by aggregate sorted by version": db.command(
+            "explain", {"find": "events", "filter": {"aggregate_id": "x", "version": {"$gte": 1}},
+                        "sort": {"version": 1}}),
+        "history page of an aggregate": db.command(
+            "explain", {"find": "events", "filter": {"aggregate_id": "x", "version": {"$gte": 1, "$gt": 10},
+                                                     "event_type": {"$in": ["NoteUpdated"]}},
+                        "sort": {"version": 1}, "limit": 50}),
+        "latest version of an aggregate": db.command(
+            "explain", {"find": "events", "filter": {"aggregate_id": "x", "version": {"$gte": 1}},
+                        "sort": {"version": -1}, "limit": 1}),
+        "distinct aggregate ids of a user": db.command(
+            "explain", {"distinct": "events", "key": "aggregate_id", "query": {"user_id": "x"}}),
+        "events of a user grouped by aggregate": db.command(
+            "explain", {"aggregate": "events", "pipeline": user_aggregates_pipeline("x", limit=20), "cursor": {}}),
+        "events stored in a time range": db.command(
+            "explain", {"aggregate": "events", "pipeline": [
+                {"$match": {"timestamp": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 1, 2)},
+                            "version": {"$gte": 1}}},
+                {"$group": {"_id": "$aggregate_id", "version": {"$max": "$version"}}}], "cursor": {}}),
+        "recent notes of a user": db.command(
+            "explain", {"find": "notes_current", "filter": {"user_id": "x", "deleted": False},
+                        "sort": {"last_event_at": -1, "_id": -1}}),
+    }
+
+    failed = False
+    for name, explain in queries.items():
+        stages = plan_stages(winning_plan(explain))
+        # A SORT above a GROUP, e.g. pushed down from an aggregation, orders the groups and not the documents
+        documents = stages[len(stages) - stages[::-1].index("GROUP"):] if "GROUP" in stages else stages
+        covered = "COLLSCAN" not in stages and "SORT" not in documents
+        failed = failed or not covered
+        print(f"{'OK ' if covered else 'FAIL'} {name}: {' <- '.join(stages)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
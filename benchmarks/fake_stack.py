@@ -0,0 +1,254 @@
+"""Gateway, notes_service and auth_service in one process, on in-process fakes of their backends.
+
+Used by `load_test.py --in-process`. Consul is a dictionary seeded from
+consul_loader/config.json that also answers the gateway's health queries with
+the services started here. Redis is fakeredis, MongoDB is mongomock behind
+mongomock-motor, Postgres is SQLite through aiosqlite. RabbitMQ and the
+consumer are replaced by a broker that folds published events into
+notes_current with the consumer's own store_events, on the notes_service event
+loop, and notifies the read-your-writes waiters the way the change stream does.
+
+The numbers measure the services' own code paths (routing, token checks,
+bcrypt, templates, projection folding) without network hops to the backends,
+so they are not comparable with a run against the compose stack.
+
+Needs the service requirements plus: pip install fakeredis mongomock-motor aiosqlite
+"""
+import asyncio
+import importlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from contextlib import contextmanager
+
+import fakeredis
+import mongomock
+import mongomock.collection
+import redis
+import redis.asyncio
+import uvicorn
+from motor import motor_asyncio
+from mongomock_motor import AsyncMongoMockClient
+from werkzeug.serving import make_server
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "consumer"))
+from projection import store_events  # noqa: E402
+
+HOST = "localhost"
+# Health queries of the gateway are blocking queries, answered after this long when nothing changed
+WATCH_WAIT = 1.0
+BROKER_BATCH_SIZE = 100
+
+
+class FakeKV:
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key):
+        value = self.values.get(key)
+        return 1, ({"Key": key, "Value": value.encode()} if value is not None else None)
+
+
+class FakeServiceRegistry:
+    def __init__(self):
+        self.instances = {}
+        self.index = 1
+        self._changed = threading.Condition()
+
+    def register(self, name, service_id=None, port=None, tags=None, check=None):
+        with self._changed:
+            self.instances.setdefault(name, {})[service_id] = port
+            self.index += 1
+            self._changed.notify_all()
+
+    def service(self, name, passing=False, index=None, wait=None):
+        with self._changed:
+            if index is not None and int(index) == self.index:
+                self._changed.wait(WATCH_WAIT)
+            instances = self.instances.get(name, {})
+            return str(self.index), [{"Service": {"ID": service_id, "Port": port}}
+                                     for service_id, port in instances.items()]
+
+
+class FakeConsul:
+    def __init__(self, values):
+        self.kv = FakeKV(values)
+        registry = FakeServiceRegistry()
+        self.agent = types.SimpleNamespace(service=registry)
+        self.health = registry
+
+
+def fake_consul_module(client):
+    module = types.ModuleType("consul")
+    module.Consul = lambda *args, **kwargs: client
+    module.Check = types.SimpleNamespace(http=lambda url, interval=None: {"http": url, "interval": interval})
+    return module
+
+
+class FakeBroker:
+    """Stands in for the EventPublisher, RabbitMQ and the consumer of one notes_service."""
+
+    def __init__(self, db, note_changes, snapshot_interval):
+        self.db = db
+        self.note_changes = note_changes
+        self.snapshot_interval = snapshot_interval
+        self._queue = None
+        self._task = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._consume())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def publish(self, event, headers=None):
+        self._queue.put_nowait(dict(event))
+
+    async def _consume(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < BROKER_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+            for event in batch:
+                # Mongo keeps milliseconds, as the consumer's parse_event does
+                timestamp = event["timestamp"]
+                event["timestamp"] = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+            try:
+                store_events(self.db, batch, self.snapshot_interval)
+            except Exception as exc:
+                # The real consumer would crash and get the batch redelivered, here it would stop silently
+                print(f"Folding {len(batch)} events failed: {exc!r}")
+                continue
+            note_ids = list({event["aggregate_id"] for event in batch})
+            # What the notes_current change stream would report
+            for note in self.db["notes_current"].find({"_id": {"$in": note_ids}}):
+                self.note_changes._notify(note)
+
+
+async def _no_change_stream():
+    pass
+
+
+def _projection_without_expressions(mongo_projection):
+    """mongomock cannot evaluate $substrCP in a find projection, fetch the content and let present() cut it."""
+    def projection(fields):
+        fetched = mongo_projection(fields)
+        if isinstance(fetched.get("preview"), dict):
+            del fetched["preview"]
+            fetched["content"] = 1
+        return fetched
+    return projection
+
+
+def _accept_bulk_sort():
+    """pymongo 4.11+ passes `sort` to bulk replaces, which mongomock does not know about yet."""
+    add_replace = mongomock.collection.BulkOperationBuilder.add_replace
+
+    def add_replace_without_sort(self, selector, doc, upsert, collation=None, hint=None, sort=None):
+        return add_replace(self, selector, doc, upsert, collation=collation, hint=hint)
+
+    mongomock.collection.BulkOperationBuilder.add_replace = add_replace_without_sort
+
+
+@contextmanager
+def _instant_consul_polls():
+    # get_members sleeps 5 seconds after every Consul read, even a successful one
+    sleep = time.sleep
+    time.sleep = lambda seconds: None
+    try:
+        yield
+    finally:
+        time.sleep = sleep
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def load_service(directory, port):
+    """Import a service's `app` package and move it out of the way, every service names its package `app`."""
+    os.environ["PORT"] = str(port)
+    os.environ["SERVICE_NAME"] = HOST
+    path = os.path.join(ROOT, directory)
+    sys.path.insert(0, path)
+    try:
+        with _instant_consul_polls():
+            package = importlib.import_module("app")
+    finally:
+        sys.path.remove(path)
+        for name in [name for name in sys.modules if name == "app" or name.startswith("app.")]:
+            module = sys.modules.pop(name)
+            moved = f"{directory}_{name}".replace(".", "_")
+            sys.modules[moved] = module
+            # Functions sent to a process pool (bcrypt) are pickled by module name
+            for value in vars(module).values():
+                if isinstance(value, types.FunctionType) and value.__module__ == name:
+                    value.__module__ = moved
+    return package
+
+
+def serve_asgi(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host=HOST, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+
+def serve_wsgi(app, port):
+    # The request log of werkzeug would drown the report
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server(HOST, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+def start_stack():
+    """Start the three services on fakes and return the gateway URL."""
+    with open(os.path.join(ROOT, "consul_loader", "config.json")) as config:
+        values = json.load(config)
+    workdir = tempfile.mkdtemp(prefix="notes-load-")
+    values.update({
+        "mongo": "mongomock",
+        "rabbitmq": "fake",
+        "redis/token_servers": f"{HOST}:6379",
+        "postgres": f"sqlite+aiosqlite:///{os.path.join(workdir, 'auth.db')}",
+    })
+    # Exercise the signed identity the gateway forwards
+    os.environ.setdefault("GATEWAY_SECRET", "load-test-gateway-secret")
+    os.environ.setdefault("JWT_SECRET", "load-test-jwt-secret")
+
+    consul = FakeConsul(values)
+    sys.modules["consul"] = fake_consul_module(consul)
+    redis_server = fakeredis.FakeServer()
+    redis.Redis = lambda *args, **kwargs: fakeredis.FakeRedis(
+        server=redis_server, decode_responses=kwargs.get("decode_responses", False))
+    redis.asyncio.Redis = lambda *args, **kwargs: fakeredis.FakeAsyncRedis(
+        server=redis_server, decode_responses=kwargs.get("decode_responses", False))
+    _accept_bulk_sort()
+    mongo = mongomock.MongoClient()
+    motor_asyncio.AsyncIOMotorClient = lambda *args, **kwargs: AsyncMongoMockClient(mock_mongo_client=mongo)
+
+    auth_port, notes_port, gateway_port = free_port(), free_port(), free_port()
+    auth = load_service("auth_service", auth_port)
+    notes = load_service("notes_service", notes_port)
+    routes = sys.modules["notes_service_app_routes"]
+    routes.note_changes.start = _no_change_stream
+    routes.mongo_projection = _projection_without_expressions(routes.mongo_projection)
+    routes.publisher = FakeBroker(mongo["notes_db"], routes.note_changes, int(values["notes/snapshot_interval"]))
+    serve_asgi(auth.app, auth_port)
+    serve_asgi(notes.app, notes_port)
+    gateway = load_service("api_gateway", gateway_port)
+    serve_wsgi(gateway.app, gateway_port)
+    print(f"In-process stack: gateway on {gateway_port}, auth_service on {auth_port}, notes_service on {notes_port}")
+    return f"http://{HOST}:{gateway_port}"
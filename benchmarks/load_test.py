@@ -0,0 +1,247 @@
+"""End-to-end load test of the gateway with per-route latency percentiles.
+
+Every virtual user is a thread with its own cookie session. It signs up, logs
+in and then either runs a weighted mix of note operations for a fixed duration
+or takes its share of a recorded request log. The login operation of the mix
+logs out first. Forms are fetched first for their CSRF token and redirects are
+not followed, so each row of the report measures one gateway route.
+
+The target is a running gateway, e.g. the compose stack, or with --in-process
+the gateway, notes_service and auth_service started in this process on fakes
+of Consul, Redis, RabbitMQ and MongoDB (see fake_stack.py).
+
+A recorded log is JSON lines, replayed in order by the users round robin:
+    {"op": "create"}                          one of the operations of --mix
+    {"method": "GET", "path": "/note_history/{note}"}
+{note} is replaced by a note the replaying user created.
+
+Usage: python benchmarks/load_test.py --gateway http://localhost:5000 --users 20 --duration 60 \\
+           --mix list=10,view=5,create=2,update=3,history=2
+       python benchmarks/load_test.py --replay recorded.jsonl --users 20 --report results.json
+       python benchmarks/load_test.py --in-process --users 5 --duration 30
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import threading
+import time
+from collections import defaultdict
+from uuid import uuid4
+
+import requests
+
+CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+DEFAULT_MIX = "list=10,view=5,create=2,update=3,history=2"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route, latency, ok):
+        with self._lock:
+            if ok:
+                self.latencies[route].append(latency)
+            else:
+                self.errors[route] += 1
+
+
+class VirtualUser:
+    def __init__(self, gateway, recorder, rng):
+        self.gateway = gateway
+        self.recorder = recorder
+        self.rng = rng
+        self.session = requests.Session()
+        self.notes = []
+        self.email = f"load-{uuid4().hex[:12]}@example.com"
+        self.logged_in = False
+
+    def request(self, route, method, path, data=None, expect=(200, 302, 304)):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.gateway + path, data=data, allow_redirects=False,
+                                            timeout=30)
+            ok = response.status_code in expect
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(route, time.perf_counter() - started, ok)
+        return response if ok else None
+
+    def submit(self, route, path, fields):
+        form = self.request(f"GET {route}", "GET", path, expect=(200,))
+        match = CSRF.search(form.text) if form is not None else None
+        if match is None:
+            return None
+        return self.request(f"POST {route}", "POST", path, data={"csrf_token": match.group(1), **fields},
+                            expect=(302,))
+
+    def signup(self):
+        self.submit("/signup", "/signup", {"username": self.email[5:17], "email": self.email,
+                                           "password": "load-test", "confirm_password": "load-test"})
+
+    def login(self):
+        # The gateway redirects logged in users away from the login form
+        if self.logged_in:
+            self.request("GET /logout", "GET", "/logout", expect=(302,))
+            self.session.cookies.set("access_token_cookie", None)
+            self.logged_in = False
+        response = self.submit("/login", "/login", {"email": self.email, "password": "load-test"})
+        token = response.cookies.get("access_token_cookie") if response is not None else None
+        if token:
+            # The cookie is marked Secure, which the session would not send back over plain http
+            self.session.cookies.set("access_token_cookie", None)
+            self.session.cookies.set("access_token_cookie", token)
+            self.logged_in = True
+
+    def create(self):
+        response = self.submit("/new_note", "/new_note", {"title": f"note {len(self.notes) + 1}",
+                                                          "content": self.text()})
+        # The redirect carries the write token <note_id>:<version>
+        token = re.search(r"min_version=([^&:%]+)(?::|%3A)", response.headers.get("Location", "")) if response else None
+        if token:
+            self.notes.append(token.group(1))
+
+    def update(self):
+        if not self.notes:
+            return self.create()
+        self.submit("/view_note/{note}", f"/view_note/{self.rng.choice(self.notes)}", {"content": self.text()})
+
+    def list(self):
+        self.request("GET /notes", "GET", "/notes")
+
+    def view(self):
+        if self.notes:
+            self.request("GET /view_note/{note}", "GET", f"/view_note/{self.rng.choice(self.notes)}")
+
+    def history(self):
+        if self.notes:
+            self.request("GET /note_history/{note}", "GET", f"/note_history/{self.rng.choice(self.notes)}")
+
+    def replay(self, entry):
+        if "op" in entry:
+            if entry["op"] not in OPERATIONS:
+                raise ValueError(f"Unknown operation {entry['op']!r} in the request log")
+            return getattr(self, entry["op"])()
+        path = entry["path"]
+        route = f"{entry['method']} {path}"
+        if "{note}" in path:
+            if not self.notes:
+                self.create()
+            path = path.replace("{note}", self.rng.choice(self.notes) if self.notes else "missing")
+        self.request(route, entry["method"], path, data=entry.get("form"))
+
+    def text(self):
+        return " ".join(self.rng.choices(["note", "event", "queue", "cache", "index", "token"], k=40))
+
+
+OPERATIONS = ("list", "view", "create", "update", "history", "login")
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {op!r} in --mix")
+        weights[op] = float(weight or 1)
+    return weights
+
+
+def run_mix(user, weights, deadline):
+    ops, op_weights = list(weights), list(weights.values())
+    while time.perf_counter() < deadline:
+        getattr(user, user.rng.choices(ops, op_weights)[0])()
+
+
+def run_replay(user, entries):
+    for entry in entries:
+        user.replay(entry)
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1] * 1000 if len(values) > 1 else float("nan")
+
+
+def report(recorder, elapsed):
+    rows = []
+    for route in sorted(set(recorder.latencies) | set(recorder.errors)):
+        latencies = recorder.latencies[route]
+        rows.append({
+            "route": route,
+            "requests": len(latencies),
+            "errors": recorder.errors[route],
+            "rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+        })
+    print(f"{'route':<30} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for row in rows:
+        print(f"{row['route']:<30} {row['requests']:>9} {row['errors']:>7} {row['rps']:>8.1f} "
+              f"{row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gateway", default="http://localhost:5000")
+    parser.add_argument("--in-process", action="store_true",
+                        help="start the services in this process on fake backends instead of using --gateway")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of the synthetic mix")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of list, view, create, update, history, login")
+    parser.add_argument("--replay", help="JSON lines request log to replay instead of the mix")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    gateway = args.gateway
+    if args.in_process:
+        from fake_stack import start_stack
+        gateway = start_stack()
+
+    setup = Recorder()
+    users = [VirtualUser(gateway.rstrip("/"), setup, random.Random(args.seed + i)) for i in range(args.users)]
+    started = time.perf_counter()
+    for user in users:
+        user.signup()
+        user.login()
+    print("Sign up and login of every user")
+    report(setup, time.perf_counter() - started)
+
+    recorder = Recorder()
+    for user in users:
+        user.recorder = recorder
+
+    if args.replay:
+        with open(args.replay) as log:
+            entries = [json.loads(line) for line in log if line.strip()]
+        shares = [entries[i::args.users] for i in range(args.users)]
+        threads = [threading.Thread(target=run_replay, args=(user, share)) for user, share in zip(users, shares)]
+    else:
+        weights = parse_mix(args.mix)
+        deadline = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=run_mix, args=(user, weights, deadline)) for user in users]
+
+    print("\nLoad")
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    rows = report(recorder, elapsed)
+    print(f"{sum(row['requests'] for row in rows) / elapsed:.1f} req/s overall over {elapsed:.1f} s")
+    if args.report:
+        with open(args.report, "w") as out:
+            json.dump({"users": args.users, "elapsed_s": elapsed, "mix": None if args.replay else args.mix,
+                       "replay": args.replay, "routes": rows}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
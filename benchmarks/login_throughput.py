@@ -0,0 +1,68 @@
+"""Logins/sec of a running auth_service instance, overall and per hashing core.
+
+Registers a benchmark user (ignoring "already registered") and then logs in
+from concurrent clients for a fixed duration. Shed requests (503) are counted
+separately from successful logins.
+
+With --unknown-users every login uses an email that does not exist, so no
+bcrypt work is done and the numbers measure the database stack alone.
+
+Usage: python benchmarks/login_throughput.py --url http://localhost:5001 --clients 32 --cores 4
+       python benchmarks/login_throughput.py --unknown-users --clients 50,200,1000
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+from uuid import uuid4
+
+import requests
+
+
+def client(url, email, password, deadline, statuses, unknown_users):
+    session = requests.Session()
+    while time.perf_counter() < deadline:
+        if unknown_users:
+            email = f"{uuid4().hex}@example.com"
+        try:
+            response = session.post(f"{url}/login", params={"email": email, "password": password}, timeout=30)
+            statuses[response.status_code] += 1
+        except requests.RequestException:
+            statuses["error"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--email", default="login-bench@example.com")
+    parser.add_argument("--password", default="login-bench-password")
+    parser.add_argument("--clients", default="32")
+    parser.add_argument("--unknown-users", action="store_true")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--cores", type=int, default=1, help="HASH_WORKERS of the instance under test")
+    args = parser.parse_args()
+
+    requests.post(f"{args.url}/signup", params={"username": "login-bench", "email": args.email,
+                                                "password": args.password}, timeout=30)
+
+    for clients in [int(c) for c in args.clients.split(",")]:
+        statuses = Counter()
+        deadline = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=client, args=(args.url, args.email, args.password, deadline, statuses,
+                                                          args.unknown_users))
+                   for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        answered = statuses[401 if args.unknown_users else 200] / args.duration
+        if args.unknown_users:
+            print(f"{clients:>5} clients: {answered:.1f} lookups/sec")
+        else:
+            print(f"{clients:>5} clients: {answered:.1f} logins/sec ({answered / args.cores:.1f} per core)")
+        print(f"      responses: {dict(statuses)}")
+
+
+if __name__ == "__main__":
+    main()
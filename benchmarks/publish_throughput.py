@@ -0,0 +1,86 @@
+"""Writes/sec of the RabbitMQ publish path: connection per event vs. the shared EventPublisher.
+
+Publishes synthetic note events to scratch partition queues on a running
+broker, from a thread pool for the old blocking code and from concurrent
+coroutines for the shared aio-pika publisher, and reports throughput.
+
+Usage: python benchmarks/publish_throughput.py --host localhost --events 2000 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+import pika
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service", "app"))
+from publisher import EventPublisher, partition_queue  # noqa: E402
+
+QUEUE = "note_events_bench"
+PARTITIONS = 4
+
+
+def make_event():
+    return {"aggregate_id": str(uuid4()), "user_id": "bench", "event_type": "NoteUpdated",
+            "timestamp": datetime.utcnow(), "data": {"content": "x" * 256}}
+
+
+def connection_per_event(host, events, concurrency):
+    def publish(_):
+        event = make_event()
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+        channel = connection.channel()
+        routing_key = partition_queue(QUEUE, event["aggregate_id"], PARTITIONS)
+        channel.queue_declare(queue=routing_key, durable=True, arguments={"x-single-active-consumer": True})
+        channel.basic_publish(exchange='', routing_key=routing_key, body=json.dumps(event, default=str),
+                              properties=pika.BasicProperties(delivery_mode=2))
+        connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(publish, range(events)))
+    return events / (time.perf_counter() - started)
+
+
+async def shared_publisher(host, events, concurrency):
+    publisher = EventPublisher(host, QUEUE, partitions=PARTITIONS)
+    await publisher.start()
+    remaining = iter(range(events))
+
+    async def worker():
+        for _ in remaining:
+            await publisher.publish(make_event())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    rate = events / (time.perf_counter() - started)
+    await publisher.close()
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    rate = connection_per_event(args.host, args.events, args.concurrency)
+    print(f"{'connection per event':<22} {rate:>10.1f} writes/sec")
+    rate = asyncio.run(shared_publisher(args.host, args.events, args.concurrency))
+    print(f"{'shared publisher':<22} {rate:>10.1f} writes/sec")
+
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=args.host))
+    channel = connection.channel()
+    for partition in range(PARTITIONS):
+        channel.queue_delete(queue=f"{QUEUE}.{partition}")
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
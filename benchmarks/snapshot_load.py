@@ -0,0 +1,91 @@
+"""Note load time against history length, with and without snapshots.
+
+Seeds one note with a long NoteUpdated history in a running MongoDB and times
+loading it by full replay and by newest snapshot plus the events after it.
+
+Usage: python benchmarks/snapshot_load.py --mongo mongodb://localhost:27017/?directConnection=true
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service", "app"))
+from models import NoteAggregate  # noqa: E402
+
+
+def seed(db, history, interval):
+    db.events.drop()
+    db.snapshots.drop()
+    note_id = "bench-note"
+    ts = datetime.utcnow()
+    events = [{"aggregate_id": note_id, "user_id": "bench", "event_type": "NoteCreated", "version": 1,
+               "timestamp": ts, "data": {"title": "bench", "content": "x" * 512}}]
+    snapshots = []
+    for version in range(2, history + 1):
+        ts += timedelta(milliseconds=1)
+        content = f"{version} " + "x" * 512
+        events.append({"aggregate_id": note_id, "user_id": "bench", "event_type": "NoteUpdated", "version": version,
+                       "timestamp": ts, "data": {"content": content}})
+        if version % interval == 0:
+            snapshots.append({"aggregate_id": note_id, "version": version, "timestamp": ts,
+                              "state": {"title": "bench", "content": content, "user_id": "bench"}})
+    db.events.insert_many(events)
+    if snapshots:
+        db.snapshots.insert_many(snapshots)
+    db.events.create_index([("aggregate_id", 1), ("version", 1)], unique=True,
+                           partialFilterExpression={"version": {"$exists": True}})
+    db.snapshots.create_index([("aggregate_id", 1), ("version", -1)])
+    return note_id
+
+
+def full_replay(db, note_id):
+    aggregate = NoteAggregate(note_id)
+    aggregate.load_from_events(db.events.find({"aggregate_id": note_id, "version": {"$gte": 1}}).sort("version"))
+    return aggregate
+
+
+def from_snapshot(db, note_id):
+    aggregate = NoteAggregate(note_id)
+    query = {"aggregate_id": note_id, "version": {"$gte": 1}}
+    snapshot = db.snapshots.find_one({"aggregate_id": note_id}, sort=[("version", -1)])
+    if snapshot:
+        aggregate.load_from_snapshot(snapshot)
+        query["version"] = {"$gt": snapshot["version"]}
+    aggregate.load_from_events(db.events.find(query).sort("version"))
+    return aggregate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/?directConnection=true")
+    parser.add_argument("--history", default="100,1000,10000")
+    parser.add_argument("--interval", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo)
+    db = client["notes_bench"]
+    print(f"{'events':>7} {'full replay ms':>15} {'snapshot ms':>12}")
+    for history in [int(n) for n in args.history.split(",")]:
+        note_id = seed(db, history, args.interval)
+        results = []
+        for load in (full_replay, from_snapshot):
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                aggregate = load(db, note_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            assert aggregate.version == history
+            results.append(statistics.median(timings))
+        print(f"{history:>7} {results[0]:>15.2f} {results[1]:>12.2f}")
+    client.drop_database("notes_bench")
+
+
+if __name__ == "__main__":
+    main()
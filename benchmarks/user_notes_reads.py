@@ -0,0 +1,118 @@
+"""Round trips and latency of GET /users/{user_id}/notes read paths against note count.
+
+Seeds a scratch database in a running MongoDB and compares:
+  * n_plus_one  - distinct() followed by one find() per note (the old code path)
+  * aggregation - single $group pipeline folded into NoteAggregate (NOTES_READ_MODEL=events)
+  * projection  - one find() on notes_current (default read model)
+
+Usage: python benchmarks/user_notes_reads.py --mongo mongodb://localhost:27017/?directConnection=true
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from pymongo import MongoClient, monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notes_service", "app"))
+from models import NoteAggregate  # noqa: E402
+from pagination import user_aggregates_pipeline  # noqa: E402
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def seed(db, user_id, notes, updates):
+    db.events.drop()
+    db.notes_current.drop()
+    start = datetime.utcnow()
+    events = []
+    projections = []
+    for i in range(notes):
+        note_id = str(uuid4())
+        ts = start + timedelta(seconds=i)
+        events.append({"aggregate_id": note_id, "user_id": user_id, "event_type": "NoteCreated", "version": 1,
+                       "timestamp": ts, "data": {"title": f"note {i}", "content": "v0"}})
+        for v in range(updates):
+            ts += timedelta(milliseconds=1)
+            events.append({"aggregate_id": note_id, "user_id": user_id, "event_type": "NoteUpdated",
+                           "version": v + 2, "timestamp": ts, "data": {"content": f"v{v + 1}"}})
+        projections.append({"_id": note_id, "user_id": user_id, "title": f"note {i}",
+                            "content": f"v{updates}", "deleted": False, "version": updates + 1,
+                            "last_event_at": ts})
+    db.events.insert_many(events)
+    db.notes_current.insert_many(projections)
+    db.events.create_index([("aggregate_id", 1), ("version", 1)], unique=True,
+                           partialFilterExpression={"version": {"$exists": True}})
+    db.events.create_index([("user_id", 1), ("aggregate_id", 1), ("version", 1)])
+    db.notes_current.create_index([("user_id", 1), ("deleted", 1), ("last_event_at", -1), ("_id", -1)])
+
+
+def n_plus_one(db, user_id):
+    notes = []
+    for note_id in db.events.distinct("aggregate_id", {"user_id": user_id}):
+        aggregate = NoteAggregate(note_id)
+        aggregate.load_from_events(db.events.find({"aggregate_id": note_id, "version": {"$gte": 1}}).sort("version"))
+        notes.append(aggregate.state)
+    return notes
+
+
+def aggregation(db, user_id):
+    pipeline = user_aggregates_pipeline(user_id)
+    notes = []
+    for group in db.events.aggregate(pipeline, allowDiskUse=True):
+        aggregate = NoteAggregate(group["_id"])
+        aggregate.load_from_events(group["events"])
+        notes.append(aggregate.state)
+    return notes
+
+
+def projection(db, user_id):
+    query = {"user_id": user_id, "deleted": False}
+    return list(db.notes_current.find(query).sort([("last_event_at", -1), ("_id", -1)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/?directConnection=true")
+    parser.add_argument("--notes", default="10,100,500")
+    parser.add_argument("--updates", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    counter = CommandCounter()
+    client = MongoClient(args.mongo, event_listeners=[counter])
+    db = client["notes_bench"]
+    user_id = "bench@example.com"
+
+    print(f"{'notes':>6} {'path':<12} {'round trips':>11} {'median ms':>10}")
+    for notes in [int(n) for n in args.notes.split(",")]:
+        seed(db, user_id, notes, args.updates)
+        for name, read in (("n_plus_one", n_plus_one), ("aggregation", aggregation), ("projection", projection)):
+            timings = []
+            for _ in range(args.repeat):
+                counter.count = 0
+                started = time.perf_counter()
+                read(db, user_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{notes:>6} {name:<12} {counter.count:>11} {statistics.median(timings):>10.2f}")
+    client.drop_database("notes_bench")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+from pymongo import ReplaceOne, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from shared.delta import apply_delta
+
+DUPLICATE_KEY = 11000
+
+
+def apply_event(state, event):
+    """Fold a single event into the current state of a note."""
+    if state is None:
+        state = {"_id": event["aggregate_id"], "version": 0}
+    else:
+        state = dict(state)
+
+    if event["event_type"] == "NoteCreated":
+        state.update(event["data"])
+        state["user_id"] = event["user_id"]
+        state["deleted"] = False
+    elif event["event_type"] == "NoteUpdated":
+        data = event["data"]
+        state["content"] = apply_delta(state.get("content", ""), data["delta"]) if "delta" in data else data["content"]
+    elif event["event_type"] == "NoteDeleted":
+        state["deleted"] = True
+
+    state["version"] += 1
+    state["last_event_at"] = event["timestamp"]
+    return state
+
+
+def make_snapshot(state):
+    snapshot_state = {key: value for key, value in state.items()
+                      if key not in ("_id", "version", "last_event_at")}
+    return {
+        "aggregate_id": state["_id"],
+        "version": state["version"],
+        "timestamp": state["last_event_at"],
+        "state": snapshot_state,
+    }
+
+
+def store_events(db, events, snapshot_interval=0, behind=()):
+    """Fold a batch of events into notes_current in version order.
+
+    notes_service stores every event at its version before publishing it, so
+    an event that arrives ahead of a missing one is left for later and the
+    note catches up from the event log once the gap is filled. Notes listed in
+    `behind` catch up from the log as well. Events from publishers that
+    predate versions are stamped and stored here, the unique event_id index
+    rejects their redeliveries. Folding only the next version and never
+    writing a note back to an older version makes replaying a batch after a
+    crash, or racing the log sweep of another consumer, harmless.
+    """
+    aggregate_ids = list({event["aggregate_id"] for event in events} | set(behind))
+    states = {state["_id"]: state for state in db["notes_current"].find({"_id": {"$in": aggregate_ids}})}
+    changed = set()
+    behind = set(behind)
+    unversioned = []
+    snapshots = []
+
+    def fold(event):
+        state = apply_event(states.get(event["aggregate_id"]), event)
+        states[state["_id"]] = state
+        changed.add(state["_id"])
+        if snapshot_interval and state["version"] % snapshot_interval == 0:
+            snapshots.append(make_snapshot(state))
+
+    for event in events:
+        state = states.get(event["aggregate_id"])
+        current = state["version"] if state else 0
+        if event.get("version") is None:
+            unversioned.append(event)
+            if state is not None and event["timestamp"] <= state["last_event_at"]:
+                continue
+            event["version"] = current + 1
+        elif event["version"] != current + 1:
+            if event["version"] > current + 1:
+                behind.add(event["aggregate_id"])
+            continue
+        fold(event)
+
+    for note_id in behind:
+        current = states[note_id]["version"] if note_id in states else 0
+        for event in db["events"].find({"aggregate_id": note_id, "version": {"$gt": current}}).sort("version"):
+            if event["version"] != states.get(note_id, {"version": 0})["version"] + 1:
+                break
+            fold(event)
+
+    if unversioned:
+        try:
+            db["events"].insert_many(unversioned, ordered=False)
+        except BulkWriteError as exc:
+            if any(error["code"] != DUPLICATE_KEY for error in exc.details["writeErrors"]):
+                raise
+
+    if changed:
+        # A note already stored at this version or later fails the filter, its upsert is a duplicate key
+        try:
+            db["notes_current"].bulk_write(
+                [ReplaceOne({"_id": note_id, "version": {"$lt": states[note_id]["version"]}}, states[note_id],
+                            upsert=True) for note_id in changed],
+                ordered=False
+            )
+        except BulkWriteError as exc:
+            if any(error["code"] != DUPLICATE_KEY for error in exc.details["writeErrors"]):
+                raise
+    if snapshots:
+        db["snapshots"].insert_many(snapshots, ordered=False)
+
+
+def sweep_log(db, since, until, snapshot_interval=0):
+    """Catch up notes whose events in the log, stored between since and until, are not all projected.
+
+    A write is committed once its event is in the log. An event whose publish
+    failed, or that was lost with a notes_service worker's publish buffer,
+    never arrives through the queue and is only folded here. Returns the
+    number of notes that were behind.
+    """
+    pipeline = [
+        {"$match": {"timestamp": {"$gte": since, "$lt": until}, "version": {"$gte": 1}}},
+        {"$group": {"_id": "$aggregate_id", "version": {"$max": "$version"}}},
+    ]
+    latest = {group["_id"]: group["version"] for group in db["events"].aggregate(pipeline)}
+    if not latest:
+        return 0
+    projected = {note["_id"]: note["version"]
+                 for note in db["notes_current"].find({"_id": {"$in": list(latest)}}, {"version": 1})}
+    behind = [note_id for note_id, version in latest.items() if projected.get(note_id, 0) < version]
+    if behind:
+        store_events(db, [], snapshot_interval, behind)
+    return len(behind)
+
+
+def rebuild_projection(db, batch_size=500):
+    """Replay the whole events collection into a fresh notes_current.
+
+    Events recorded before versions were assigned get their version on the way.
+    """
+    target = db["notes_current_rebuild"]
+    target.drop()
+    target.create_index([("user_id", ASCENDING), ("deleted", ASCENDING), ("last_event_at", DESCENDING),
+                         ("_id", DESCENDING)], name="user_recent_notes")
+
+    # Events without a version predate them and come first
+    cursor = db["events"].find().sort([("aggregate_id", 1), ("version", 1), ("timestamp", 1)])
+    requests = []
+    versions = []
+    state = None
+    rebuilt = 0
+    for event in cursor:
+        if state is not None and state["_id"] != event["aggregate_id"]:
+            requests.append(ReplaceOne({"_id": state["_id"]}, state, upsert=True))
+            rebuilt += 1
+            state = None
+        state = apply_event(state, event)
+        if event.get("version") != state["version"]:
+            versions.append(UpdateOne({"_id": event["_id"]}, {"$set": {"version": state["version"]}}))
+        if len(requests) >= batch_size:
+            target.bulk_write(requests, ordered=False)
+            requests = []
+        if len(versions) >= batch_size:
+            db["events"].bulk_write(versions, ordered=False)
+            versions = []
+    if state is not None:
+        requests.append(ReplaceOne({"_id": state["_id"]}, state, upsert=True))
+        rebuilt += 1
+    if requests:
+        target.bulk_write(requests, ordered=False)
+    if versions:
+        db["events"].bulk_write(versions, ordered=False)
+
+    if rebuilt:
+        target.rename("notes_current", dropTarget=True)
+    else:
+        db["notes_current"].drop()
+    return rebuilt
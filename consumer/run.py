@@ -1,7 +1,13 @@
 import pika
 import json
+import os
+import sys
 from pymongo import MongoClient
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from projection import store_events, rebuild_projection, sweep_log
+from shared import tracing
+from shared.tracing import span, record_span
+from prometheus_client import start_http_server
 
 import consul
 import time
@@ -18,8 +24,25 @@ def get_members(key):
 
 MONGO = get_members("mongo")
 RABBIT_MQ = get_members("rabbitmq")
+SNAPSHOT_INTERVAL = int(get_members("notes/snapshot_interval")[0])
+EVENT_PARTITIONS = int(get_members("notes/partitions")[0])
 replica_set = "rs0"
 
+PREFETCH = int(os.getenv("CONSUMER_PREFETCH", 200))
+BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", 100))
+FLUSH_INTERVAL = int(os.getenv("CONSUMER_FLUSH_INTERVAL_MS", 200)) / 1000
+# Partitions this instance consumes first, all of them when not set
+OWNED_PARTITIONS = [int(p) for p in os.getenv("CONSUMER_PARTITIONS", "").split(",") if p.strip()] \
+    or list(range(EVENT_PARTITIONS))
+# Seconds before subscribing to the remaining partitions as a standby, negative disables standby
+STANDBY_DELAY = int(os.getenv("CONSUMER_STANDBY_DELAY", 10))
+# The consumer has no API, Prometheus metrics are served on their own port
+METRICS_PORT = int(os.getenv("METRICS_PORT", 8000))
+# Seconds between sweeps of the event log for events that never came through the queue, 0 disables them
+SWEEP_INTERVAL = int(os.getenv("CONSUMER_SWEEP_INTERVAL", 30))
+# Events younger than this many seconds are left to the queue
+SWEEP_DELAY = int(os.getenv("CONSUMER_SWEEP_DELAY", 30))
+
 
 mongo_client = MongoClient(
     host=MONGO,
@@ -28,28 +51,105 @@ mongo_client = MongoClient(
 )
 
 db = mongo_client["notes_db"]
-events_collection = db["events"]
 
-def callback(ch, method, properties, body):
+def parse_event(body):
     event = json.loads(body)
 
     if isinstance(event.get("timestamp"), str):
         event["timestamp"] = datetime.fromisoformat(event["timestamp"].replace("Z", "+00:00"))
+    timestamp = event["timestamp"]
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    # Mongo keeps milliseconds, truncate so in-memory and stored timestamps compare equal
+    event["timestamp"] = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+    return event
+
+def flush(channel, batch):
+    with span("store batch", events=len(batch)):
+        store_events(db, [event for _, event, _ in batch], SNAPSHOT_INTERVAL)
+        channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+    # Each event continues the trace of the request that published it, from receipt until it was stored
+    now = time.time()
+    for _, event, (traceparent, received) in batch:
+        published = event["timestamp"].replace(tzinfo=timezone.utc).timestamp()
+        record_span(f"consume {event['event_type']}", traceparent, received, now - received,
+                    batch=len(batch), queued_ms=int((received - published) * 1000))
+    print(f"Stored {len(batch)} events")
 
-    events_collection.insert_one(event)
-    print(f"Event stored: {event['event_type']} for note {event['aggregate_id']}")
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+def sweep():
+    """Fold events that reached the log but not the queue, from where the last sweep of any consumer stopped."""
+    until = datetime.utcnow() - timedelta(seconds=SWEEP_DELAY)
+    state = db["consumer_state"].find_one({"_id": "log_sweep"})
+    since = state["swept_until"] if state else until - timedelta(seconds=SWEEP_INTERVAL)
+    if since >= until:
+        return
+    with span("sweep log"):
+        behind = sweep_log(db, since, until, SNAPSHOT_INTERVAL)
+    db["consumer_state"].update_one({"_id": "log_sweep"}, {"$max": {"swept_until": until}}, upsert=True)
+    if behind:
+        print(f"Caught up {behind} notes from the event log")
+
+def declare_partitions(channel):
+    # Only one consumer is active per partition queue, so events of a note stay in order
+    for partition in range(EVENT_PARTITIONS):
+        channel.queue_declare(
+            queue=f"note_events.{partition}",
+            durable=True,
+            arguments={"x-single-active-consumer": True}
+        )
 
 def main():
+    tracing.configure("consumer")
+    start_http_server(METRICS_PORT)
     connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBIT_MQ[0]))
     channel = connection.channel()
 
+    # note_events is the queue used before partitioning, drained for leftovers
     channel.queue_declare(queue='note_events', durable=True)
-    channel.basic_qos(prefetch_count=1)
+    declare_partitions(channel)
+    channel.basic_qos(prefetch_count=PREFETCH)
+
+    batch = []
+
+    def callback(ch, method, properties, body):
+        traceparent = (properties.headers or {}).get("traceparent")
+        batch.append((method.delivery_tag, parse_event(body), (traceparent, time.time())))
+
+    def subscribe(partitions):
+        for partition in partitions:
+            channel.basic_consume(queue=f"note_events.{partition}", on_message_callback=callback)
+        print(f"Subscribed to partitions {partitions}")
+
     channel.basic_consume(queue='note_events', on_message_callback=callback)
+    subscribe(OWNED_PARTITIONS)
+    standby = [p for p in range(EVENT_PARTITIONS) if p not in OWNED_PARTITIONS]
+    if standby and STANDBY_DELAY >= 0:
+        # Subscribing late lets the owners become the active consumers of these partitions
+        connection.call_later(STANDBY_DELAY, lambda: subscribe(standby))
 
     print("Waiting for events. To exit press CTRL+C")
-    channel.start_consuming()
+    first_received = None
+    next_sweep = time.monotonic()
+    while True:
+        if SWEEP_INTERVAL and time.monotonic() >= next_sweep:
+            sweep()
+            next_sweep = time.monotonic() + SWEEP_INTERVAL
+        timeout = FLUSH_INTERVAL
+        if first_received is not None:
+            timeout = max(0, first_received + FLUSH_INTERVAL - time.monotonic())
+        connection.process_data_events(time_limit=timeout)
+        if not batch:
+            continue
+        if first_received is None:
+            first_received = time.monotonic()
+        if len(batch) >= BATCH_SIZE or time.monotonic() - first_received >= FLUSH_INTERVAL:
+            flush(channel, batch)
+            batch.clear()
+            first_received = None
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["rebuild"]:
+        count = rebuild_projection(db)
+        print(f"Projection rebuilt for {count} notes")
+    else:
+        main()
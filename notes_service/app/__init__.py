@@ -1,12 +1,27 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from shared import tracing
 from app.get_services import register_service
+from app.database import ensure_indexes
 from app import routes
 import os
 
 port = int(os.getenv("PORT", ""))
 service_name = os.getenv("SERVICE_NAME", "")
 register_service("notes_service", service_name, port)
+tracing.configure("notes_service")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    await ensure_indexes()
+    await routes.publisher.start()
+    await routes.note_changes.start()
+    yield
+    await routes.note_changes.close()
+    await routes.publisher.close()
+
+app = FastAPI(lifespan=lifespan)
+
+app.middleware("http")(tracing.asgi_trace_middleware)
 
 app.include_router(routes.router)
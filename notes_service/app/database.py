@@ -0,0 +1,58 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING
+from app.get_services import MONGO
+
+replica_set = "rs0"
+
+client = AsyncIOMotorClient(
+    host=MONGO,
+    replicaSet=replica_set,
+    serverSelectionTimeoutMS=5000
+)
+db = client["notes_db"]
+events_collection = db["events"]
+notes_collection = db["notes_current"]
+snapshots_collection = db["snapshots"]
+
+EVENT_INDEXES = [
+    ([("aggregate_id", ASCENDING), ("timestamp", ASCENDING)], {"name": "aggregate_timestamp"}),
+    ([("user_id", ASCENDING), ("aggregate_id", ASCENDING), ("version", ASCENDING)], {"name": "user_aggregate_version"}),
+    ([("aggregate_id", ASCENDING), ("version", ASCENDING)], {
+        "name": "aggregate_version_unique",
+        "unique": True,
+        "partialFilterExpression": {"version": {"$exists": True}},
+    }),
+    # Serves the consumer's sweep of recently stored events
+    ([("timestamp", ASCENDING), ("aggregate_id", ASCENDING), ("version", ASCENDING)],
+     {"name": "timestamp_aggregate_version"}),
+    ([("event_id", ASCENDING)], {
+        "name": "event_id_unique",
+        "unique": True,
+        "partialFilterExpression": {"event_id": {"$exists": True}},
+    }),
+]
+
+# Replaced by an index that also serves the sort by version, dropped on start
+OBSOLETE_EVENT_INDEXES = ["user_aggregate"]
+
+NOTE_INDEXES = [
+    ([("user_id", ASCENDING), ("deleted", ASCENDING), ("last_event_at", DESCENDING), ("_id", DESCENDING)],
+     {"name": "user_recent_notes"}),
+]
+
+SNAPSHOT_INDEXES = [
+    ([("aggregate_id", ASCENDING), ("version", DESCENDING)], {"name": "aggregate_version"}),
+]
+
+async def ensure_indexes():
+    """Create the indexes used by the hot read paths. Safe to run on every start."""
+    for keys, options in EVENT_INDEXES:
+        await events_collection.create_index(keys, **options)
+    existing = await events_collection.index_information()
+    for name in OBSOLETE_EVENT_INDEXES:
+        if name in existing:
+            await events_collection.drop_index(name)
+    for keys, options in NOTE_INDEXES:
+        await notes_collection.create_index(keys, **options)
+    for keys, options in SNAPSHOT_INDEXES:
+        await snapshots_collection.create_index(keys, **options)
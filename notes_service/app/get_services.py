@@ -22,4 +22,7 @@ def register_service(service_name, service_id, service_port):
     )
 
 MONGO = get_members("mongo")
-RABBIT_MQ = get_members("rabbitmq")
\ No newline at end of file
+RABBIT_MQ = get_members("rabbitmq")
+EVENT_PARTITIONS = int(get_members("notes/partitions")[0])
+# Updates are stored as deltas with a full content checkpoint every N versions, 0 stores full content
+DELTA_CHECKPOINT_INTERVAL = int(get_members("notes/delta_checkpoint_interval")[0])
@@ -1,5 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
+from uuid import uuid4
+from typing import Optional
+from shared.delta import apply_delta
 
 class NoteCreate(BaseModel):
     user_id: str
@@ -10,25 +13,39 @@ class NoteUpdate(BaseModel):
     content: str
 
 class Event(BaseModel):
+    event_id: str = Field(default_factory=lambda: str(uuid4()))
     aggregate_id: str
     user_id: str
     event_type: str
+    version: Optional[int] = None
     timestamp: datetime
     data: dict
 
+def updated_content(content, data):
+    """Content after a NoteUpdated event, which carries either the full content or a delta."""
+    if 'delta' in data:
+        return apply_delta(content, data['delta'])
+    return data['content']
+
 class NoteAggregate:
     def __init__(self, note_id):
         self.note_id = note_id
         self.state = {}
+        self.version = 0
 
     def apply_event(self, event):
         if event['event_type'] == 'NoteCreated':
             self.state = event['data']
             self.state['user_id'] = event['user_id']
         elif event['event_type'] == 'NoteUpdated':
-            self.state['content'] = event['data']['content']
+            self.state['content'] = updated_content(self.state.get('content', ''), event['data'])
         elif event['event_type'] == 'NoteDeleted':
             self.state['deleted'] = True
+        self.version += 1
+
+    def load_from_snapshot(self, snapshot):
+        self.state = dict(snapshot['state'])
+        self.version = snapshot['version']
 
     def load_from_events(self, events):
         for event in events:
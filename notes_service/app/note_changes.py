@@ -0,0 +1,97 @@
+import asyncio
+from collections import defaultdict
+
+from pymongo.errors import PyMongoError
+
+RETRY_DELAY = 1
+
+
+class NoteChanges:
+    """Follows notes_current through one change stream per worker.
+
+    Reads can wait until a note has caught up with a write, so a read right
+    after a write costs a single wait instead of client-side polling. Open
+    subscriptions get every change of their user's notes pushed to them.
+    """
+
+    def __init__(self, collection, timeout=2.0, queue_size=100):
+        self.collection = collection
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self._waiters = defaultdict(list)
+        self._subscribers = defaultdict(set)
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def wait(self, note_id, version):
+        """Wait until the note is at `version` or later, False when it did not get there in time."""
+        future = asyncio.get_running_loop().create_future()
+        waiter = (version, future)
+        # Registered before reading so an update landing in between is not missed
+        self._waiters[note_id].append(waiter)
+        try:
+            current = await self.collection.find_one({"_id": note_id}, {"version": 1})
+            if current is not None and current["version"] >= version:
+                return True
+            await asyncio.wait_for(future, self.timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            waiters = self._waiters.get(note_id)
+            if waiters is not None:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[note_id]
+
+    def subscribe(self, user_id):
+        """Queue receiving the changes of a user's notes, None is queued when changes were dropped."""
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self._subscribers.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[user_id]
+
+    def _notify(self, note):
+        for wanted, future in self._waiters.get(note["_id"], ()):
+            if wanted <= note["version"] and not future.done():
+                future.set_result(None)
+        for queue in self._subscribers.get(note.get("user_id"), ()):
+            if queue.full():
+                # A slow client refetches its list instead of holding changes in memory
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+            queue.put_nowait({
+                "note_id": note["_id"],
+                "version": note["version"],
+                "deleted": note.get("deleted", False),
+                "last_modified": note.get("last_event_at"),
+            })
+
+    async def _run(self):
+        pipeline = [
+            {"$match": {"operationType": {"$in": ["insert", "replace"]}}},
+            {"$project": {"fullDocument._id": 1, "fullDocument.user_id": 1, "fullDocument.version": 1,
+                          "fullDocument.deleted": 1, "fullDocument.last_event_at": 1}},
+        ]
+        while True:
+            try:
+                async with self.collection.watch(pipeline) as stream:
+                    async for change in stream:
+                        self._notify(change["fullDocument"])
+            except PyMongoError as exc:
+                print(f"Read model change stream failed: {exc}")
+            await asyncio.sleep(RETRY_DELAY)
@@ -0,0 +1,96 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+PREVIEW_LENGTH = int(os.getenv("NOTE_PREVIEW_LENGTH", 200))
+
+NOTE_FIELDS = ("title", "content", "preview", "user_id", "version", "last_modified")
+DEFAULT_FIELDS = ["title", "content", "user_id"]
+SUMMARY_FIELDS = ["title", "preview", "last_modified"]
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class InvalidListing(ValueError):
+    pass
+
+
+def encode_cursor(last_modified: datetime, note_id: str) -> str:
+    return f"{(last_modified - EPOCH) // timedelta(milliseconds=1)}_{note_id}"
+
+
+def decode_cursor(after: str) -> Tuple[datetime, str]:
+    millis, _, note_id = after.partition("_")
+    if not millis.isdigit() or not note_id:
+        raise InvalidListing("Invalid cursor")
+    return EPOCH + timedelta(milliseconds=int(millis)), note_id
+
+
+def after_filter(after: Optional[str]) -> dict:
+    """Filter for notes that come after the cursor in (last_event_at, _id) descending order."""
+    if not after:
+        return {}
+    last_modified, note_id = decode_cursor(after)
+    return {"$or": [
+        {"last_event_at": {"$lt": last_modified}},
+        {"last_event_at": last_modified, "_id": {"$lt": note_id}},
+    ]}
+
+
+def user_aggregates_pipeline(user_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> List[dict]:
+    """Events of a page of a user's notes grouped per note in version order, newest note first.
+
+    The (user_id, aggregate_id, version) index serves the match and the sort.
+    """
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"aggregate_id": 1, "version": 1}},
+        {"$group": {
+            "_id": "$aggregate_id",
+            "last_event_at": {"$last": "$timestamp"},
+            "events": {"$push": {"event_type": "$event_type", "user_id": "$user_id", "data": "$data"}}
+        }},
+    ]
+    if after:
+        pipeline.append({"$match": after_filter(after)})
+    pipeline.append({"$sort": {"last_event_at": -1, "_id": -1}})
+    if limit:
+        pipeline.append({"$limit": limit})
+    return pipeline
+
+
+def parse_fields(fields: Optional[str], view: Optional[str]) -> List[str]:
+    if view == "summary":
+        return SUMMARY_FIELDS
+    if view not in (None, "full"):
+        raise InvalidListing(f"Unknown view {view!r}")
+    if not fields:
+        return DEFAULT_FIELDS
+    selected = [field.strip() for field in fields.split(",") if field.strip() and field.strip() != "note_id"]
+    unknown = set(selected) - set(NOTE_FIELDS)
+    if unknown:
+        raise InvalidListing(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return selected
+
+
+def mongo_projection(fields: List[str]) -> dict:
+    """Fetch only what the response needs, previews are cut by Mongo so full content never leaves it."""
+    projection = {"_id": 1, "last_event_at": 1, "version": 1}
+    for field in fields:
+        if field == "preview":
+            projection["preview"] = {"$substrCP": ["$content", 0, PREVIEW_LENGTH]}
+        elif field != "last_modified":
+            projection[field] = 1
+    return projection
+
+
+def present(note: dict, fields: List[str]) -> dict:
+    item = {"note_id": note["_id"]}
+    for field in fields:
+        if field == "last_modified":
+            item[field] = note.get("last_event_at")
+        elif field == "preview" and "preview" not in note:
+            item[field] = note.get("content", "")[:PREVIEW_LENGTH]
+        else:
+            item[field] = note.get(field)
+    return item
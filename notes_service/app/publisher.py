@@ -0,0 +1,107 @@
+import asyncio
+import json
+import zlib
+from collections import deque
+
+import aio_pika
+from aio_pika.exceptions import AMQPError, ChannelInvalidStateError
+
+PUBLISH_ERRORS = (AMQPError, ChannelInvalidStateError, ConnectionError, asyncio.TimeoutError)
+
+
+class PublisherUnavailable(Exception):
+    pass
+
+
+def partition_queue(queue, aggregate_id, partitions):
+    """Name of the queue that carries every event of the given note."""
+    return f"{queue}.{zlib.crc32(aggregate_id.encode()) % partitions}"
+
+
+async def declare_partitions(channel, queue, partitions):
+    # A single active consumer per partition keeps events of a note in order
+    for partition in range(partitions):
+        await channel.declare_queue(
+            f"{queue}.{partition}",
+            durable=True,
+            arguments={"x-single-active-consumer": True}
+        )
+
+
+class EventPublisher:
+    """Long-lived RabbitMQ publisher shared by every request of a worker.
+
+    Keeps one robust connection and a confirming channel open; aio-pika
+    reconnects them when the broker drops. While the broker is unreachable,
+    events are held in a bounded buffer and sent in order once it is back.
+    Events are spread over `partitions` queues by a hash of their note id.
+    """
+
+    def __init__(self, host, queue, partitions=1, buffer_size=1000, flush_interval=1.0, timeout=5.0):
+        self.host = host
+        self.queue = queue
+        self.partitions = partitions
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self._buffer = deque()
+        self._connection = None
+        self._channel = None
+        self._connect_lock = asyncio.Lock()
+        self._flusher = None
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._run())
+        try:
+            await self._connect()
+        except PUBLISH_ERRORS:
+            print("Event broker is unavailable, buffering events")
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        if self._connection is not None:
+            await self._connection.close()
+
+    async def publish(self, event, headers=None):
+        message = (partition_queue(self.queue, event["aggregate_id"], self.partitions),
+                   json.dumps(event, default=str), headers)
+        # Buffered events go first so the order of a note's events is kept
+        if not self._buffer:
+            try:
+                await self._send(message)
+                return
+            except PUBLISH_ERRORS:
+                pass
+        if len(self._buffer) >= self.buffer_size:
+            raise PublisherUnavailable("Event broker is unavailable")
+        self._buffer.append(message)
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._channel is not None and not self._channel.is_closed:
+                return
+            if self._connection is None:
+                self._connection = await aio_pika.connect_robust(host=self.host, timeout=self.timeout)
+            self._channel = await self._connection.channel(publisher_confirms=True)
+            await declare_partitions(self._channel, self.queue, self.partitions)
+
+    async def _send(self, message):
+        routing_key, body, headers = message
+        await self._connect()
+        await self._channel.default_exchange.publish(
+            aio_pika.Message(body.encode(), headers=headers, delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+            routing_key=routing_key,
+            mandatory=True,
+            timeout=self.timeout
+        )
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                while self._buffer:
+                    await self._send(self._buffer[0])
+                    self._buffer.popleft()
+            except PUBLISH_ERRORS:
+                pass
@@ -1,165 +1,438 @@
-from fastapi import APIRouter, HTTPException, Response, Depends, Header
-from typing import List
-import pika
-import json
+from fastapi import APIRouter, HTTPException, Response, Depends, Header, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
 import os
-from app.get_services import MONGO, RABBIT_MQ
+from app.get_services import RABBIT_MQ, EVENT_PARTITIONS, DELTA_CHECKPOINT_INTERVAL
+from app.database import events_collection, notes_collection, snapshots_collection
 from app.models import NoteCreate, NoteUpdate, Event, NoteAggregate
+from app.publisher import EventPublisher, PublisherUnavailable
+from shared.delta import make_delta
+from shared.token_cache import TokenVerifier
+from app.note_changes import NoteChanges
+from shared.tracing import span, current_traceparent
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from app.pagination import (
+    DEFAULT_FIELDS, InvalidListing, after_filter, encode_cursor, mongo_projection, parse_fields, present,
+    user_aggregates_pipeline)
+from pymongo.errors import DuplicateKeyError
 from uuid import uuid4
-from pymongo import MongoClient
 from datetime import datetime
+import asyncio
+import hashlib
+import hmac
+import json
 import jwt
+import time
 from fastapi import status
 
-replica_set = "rs0"
+router = APIRouter()
 
+JWT_SECRET = os.getenv("JWT_SECRET", "default_value_if_not_set")
+# Signs the identity the gateway forwards, when not set every request verifies its token
+GATEWAY_SECRET = os.getenv("GATEWAY_SECRET")
+# Seconds a gateway signature stays valid, allowing for clock skew between hosts
+GATEWAY_SIGNATURE_MAX_AGE = int(os.getenv("GATEWAY_SIGNATURE_MAX_AGE", 60))
+token_verifier = TokenVerifier(JWT_SECRET)
+# "projection" serves reads from notes_current, "events" replays the event log
+READ_MODEL = os.getenv("NOTES_READ_MODEL", "projection")
+# Attempts to append an unconditional write when other writes keep taking the next version
+APPEND_RETRIES = int(os.getenv("APPEND_RETRIES", 5))
 
-client = MongoClient(
-    host=MONGO,
-    replicaSet=replica_set,
-    serverSelectionTimeoutMS=5000
-)
-db = client["notes_db"]
-events_collection = db["events"]
+publisher = EventPublisher(RABBIT_MQ[0], "note_events", partitions=EVENT_PARTITIONS,
+                           buffer_size=int(os.getenv("PUBLISH_BUFFER_SIZE", 1000)))
+note_changes = NoteChanges(notes_collection, timeout=int(os.getenv("READ_YOUR_WRITES_TIMEOUT_MS", 2000)) / 1000)
+# Seconds between keep-alive comments on idle change streams
+CHANGES_HEARTBEAT = float(os.getenv("CHANGES_HEARTBEAT", 15))
 
-router = APIRouter()
+def gateway_signed(user_id: Optional[str], timestamp: Optional[str], signature: Optional[str]) -> bool:
+    """Whether the identity comes from the gateway: a recent HMAC of the user id and time under GATEWAY_SECRET."""
+    if not (GATEWAY_SECRET and user_id and timestamp and signature and timestamp.isdigit()):
+        return False
+    if abs(time.time() - int(timestamp)) > GATEWAY_SIGNATURE_MAX_AGE:
+        return False
+    expected = hmac.new(GATEWAY_SECRET.encode(), f"{user_id}:{timestamp}".encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
 
-JWT_SECRET = os.getenv("JWT_SECRET", "default_value_if_not_set")
+async def get_user_from_token(authorization: Optional[str] = Header(None), x_user_id: Optional[str] = Header(None),
+                              x_gateway_timestamp: Optional[str] = Header(None),
+                              x_gateway_signature: Optional[str] = Header(None)) -> str:
+    # The gateway has already verified the token and forwards the identity
+    if gateway_signed(x_user_id, x_gateway_timestamp, x_gateway_signature):
+        return x_user_id
 
-def get_user_from_token(authorization: str = Header(...)) -> str:
-    if not authorization.startswith("Bearer "):
+    if authorization is None or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid Authorization header")
 
     token = authorization.replace("Bearer ", "")
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        user_id = payload.get("sub")  # Assuming 'sub' is used as user identifier in the JWT payload
-        if user_id is None:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Token does not contain user ID")
-        return user_id
+        with span("jwt verify"):
+            payload = token_verifier.verify(token)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid token")
+    user_id = payload.get("sub")  # Assuming 'sub' is used as user identifier in the JWT payload
+    if user_id is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Token does not contain user ID")
+    return user_id
 
-def publish_event(event):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBIT_MQ[0]))
-    channel = connection.channel()
-    channel.queue_declare(queue='note_events', durable=True)
-    channel.basic_publish(
-        exchange='',
-        routing_key='note_events',
-        body=json.dumps(event, default=str),
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    connection.close()
+async def publish_event(event):
+    """Queue a stored event for the projection.
+
+    The write is already committed in the event log, so a broker that is down
+    does not fail the request: the consumer's sweep of the log folds the event.
+    """
+    try:
+        with span("rabbitmq publish"):
+            # The consumer continues the trace from the message headers
+            await publisher.publish(event, headers={"traceparent": current_traceparent()})
+    except PublisherUnavailable:
+        print(f"Publish buffer is full, event {event['event_id']} is left to the consumer's log sweep")
+
+async def note_owner(note_id: str) -> Optional[str]:
+    """Owner of a note from the read model, or from its first event while the projection catches up."""
+    note = await notes_collection.find_one({"_id": note_id}, {"user_id": 1})
+    if note is None:
+        note = await events_collection.find_one({"aggregate_id": note_id, "version": 1}, {"user_id": 1})
+    return note["user_id"] if note else None
+
+async def current_version(note_id: str) -> int:
+    """Version of the newest event of a note in the event log, 0 when it has none."""
+    latest = await events_collection.find_one({"aggregate_id": note_id, "version": {"$gte": 1}}, {"version": 1},
+                                              sort=[("version", -1)])
+    return latest["version"] if latest else 0
+
+async def next_update(note_id: str, content: str):
+    """Current version of a note and the data of the NoteUpdated event that follows it.
+
+    The update is a delta against that version unless deltas are off or a checkpoint is due.
+    """
+    if not DELTA_CHECKPOINT_INTERVAL:
+        return await current_version(note_id), {"content": content}
+    aggregate = await load_aggregate(note_id)
+    version = aggregate.version if aggregate else 0
+    if aggregate is None or (version + 1) % DELTA_CHECKPOINT_INTERVAL == 0:
+        return version, {"content": content}
+    # A large diff takes tens of milliseconds of SequenceMatcher, keep it off the event loop
+    with span("make delta"):
+        delta = await asyncio.get_running_loop().run_in_executor(
+            None, make_delta, aggregate.state.get("content", ""), content)
+    if len(json.dumps(delta)) >= len(content):
+        return version, {"content": content}
+    return version, {"delta": delta, "base_version": version}
+
+async def append_event(event: Event) -> bool:
+    """Store the next version of a note in the event log and queue it for the projection.
+
+    The append is the commit. Returns False when another write already took that version.
+    """
+    try:
+        with span("mongo append", version=event.version):
+            await events_collection.insert_one(event.dict())
+    except DuplicateKeyError:
+        return False
+    await publish_event(event.dict())
+    return True
+
+async def write_event(note_id: str, user_id: str, event_type: str, content: Optional[str],
+                      expected_version: Optional[int]) -> int:
+    """Append an update or delete at the next version of a note, 409 when it has moved past expected_version."""
+    for _ in range(APPEND_RETRIES):
+        if content is not None:
+            version, data = await next_update(note_id, content)
+        else:
+            version, data = await current_version(note_id), {}
+        if expected_version is not None and version != expected_version:
+            break
+        event = Event(
+            aggregate_id=note_id,
+            user_id=user_id,
+            event_type=event_type,
+            version=version + 1,
+            timestamp=datetime.utcnow(),
+            data=data
+        )
+        if await append_event(event):
+            return event.version
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Note was changed by another request")
+
+async def load_aggregate(note_id: str) -> Optional[NoteAggregate]:
+    """Rebuild a note from its newest snapshot and the events recorded after it."""
+    aggregate = NoteAggregate(note_id)
+    query = {"aggregate_id": note_id, "version": {"$gte": 1}}
+    with span("mongo replay") as replay:
+        snapshot = await snapshots_collection.find_one({"aggregate_id": note_id}, sort=[("version", -1)])
+        if snapshot:
+            aggregate.load_from_snapshot(snapshot)
+            query["version"] = {"$gt": snapshot["version"]}
+        events = await events_collection.find(query).sort("version").to_list(length=None)
+        replay.tags["events"] = len(events)
+    if not snapshot and not events:
+        return None
+    aggregate.load_from_events(events)
+    return aggregate
+
+async def load_user_aggregates(user_id: str, limit: Optional[int] = None, after: Optional[str] = None) -> List[dict]:
+    """Replay a page of a user's notes, newest first, from a single aggregation instead of one query per note."""
+    notes = []
+    pipeline = user_aggregates_pipeline(user_id, limit, after)
+    async for group in events_collection.aggregate(pipeline, allowDiskUse=True):
+        aggregate = NoteAggregate(group["_id"])
+        aggregate.load_from_events(group["events"])
+        notes.append({**aggregate.state, "_id": group["_id"], "version": aggregate.version,
+                      "last_event_at": group["last_event_at"]})
+    return notes
 
-def get_events_for_aggregate(note_id: str) -> List[dict]:
-    return list(events_collection.find({"aggregate_id": note_id}).sort("timestamp"))
+def write_token(note_id: str, version: int) -> str:
+    """Returned by writes, a read given it as min_version sees that write."""
+    return f"{note_id}:{version}"
 
-def get_all_aggregates_for_user(user_id: str) -> List[str]:
-    note_ids = events_collection.distinct("aggregate_id", {"user_id": user_id})
-    return note_ids
+async def wait_for_write(min_version: Optional[str], response: Response, note_id: Optional[str] = None):
+    """Hold a read until the read model has the write named by min_version.
+
+    min_version is a write token, or a plain version on routes of a single note.
+    When the consumer does not catch up in time the read is served anyway and
+    marked with X-Read-Stale.
+    """
+    if not min_version:
+        return
+    if note_id is not None and min_version.isdigit():
+        wanted_note, version = note_id, min_version
+    else:
+        wanted_note, _, version = min_version.rpartition(":")
+    if not wanted_note or not version.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid min_version")
+    # The event log is written synchronously, only the projection can lag behind
+    if READ_MODEL == "events":
+        return
+    if not await note_changes.wait(wanted_note, int(version)):
+        response.headers["X-Read-Stale"] = "1"
+
+def make_etag(*parts) -> str:
+    return '"' + hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:20] + '"'
+
+def not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+async def load_note(note_id: str) -> Optional[dict]:
+    if READ_MODEL == "events":
+        aggregate = await load_aggregate(note_id)
+        return {**aggregate.state, "version": aggregate.version} if aggregate else None
+    with span("mongo read note"):
+        return await notes_collection.find_one({"_id": note_id})
+
+async def load_user_notes(user_id: str, limit: Optional[int] = None, after: Optional[str] = None,
+                          fields: List[str] = DEFAULT_FIELDS):
+    """Return a page of a user's notes, most recently modified first, and the cursor of the next page."""
+    if READ_MODEL == "events":
+        with span("mongo replay notes"):
+            found = await load_user_aggregates(user_id, limit, after)
+        notes = [note for note in found if not note.get("deleted")]
+    else:
+        query = {"user_id": user_id, "deleted": False, **after_filter(after)}
+        cursor = notes_collection.find(query, mongo_projection(fields)).sort([("last_event_at", -1), ("_id", -1)])
+        if limit:
+            cursor = cursor.limit(limit)
+        with span("mongo read notes"):
+            found = notes = await cursor.to_list(length=None)
+    next_cursor = None
+    if limit and len(found) == limit:
+        next_cursor = encode_cursor(found[-1]["last_event_at"], found[-1]["_id"])
+    return notes, next_cursor
+
+def note_state(note: dict) -> dict:
+    return {"title": note["title"], "content": note["content"], "user_id": note["user_id"], "version": note["version"]}
 
 @router.post("/notes")
-def create_note(note: NoteCreate, user_id: str = Depends(get_user_from_token)):
+async def create_note(note: NoteCreate, user_id: str = Depends(get_user_from_token)):
     note_id = str(uuid4())
     event = Event(
         aggregate_id=note_id,
         user_id=user_id,
         event_type="NoteCreated",
+        version=1,
         timestamp=datetime.utcnow(),
         data={"title": note.title, "content": note.content}
     )
-    publish_event(event.dict())
-    return {"note_id": note_id, "message": "Note created."}
+    await append_event(event)
+    return {"note_id": note_id, "version": event.version, "token": write_token(note_id, event.version),
+            "message": "Note created."}
 
 @router.put("/notes/{note_id}")
-def update_note(note_id: str, update: NoteUpdate, user_id: str = Depends(get_user_from_token)):
-    events = get_events_for_aggregate(note_id)
-    if not events:
+async def update_note(note_id: str, update: NoteUpdate, expected_version: Optional[int] = Query(None, ge=0),
+                      user_id: str = Depends(get_user_from_token)):
+    owner = await note_owner(note_id)
+    if owner is None:
         raise HTTPException(status_code=404, detail="Note not found")
-    if events[0]['user_id'] != user_id:
+    if owner != user_id:
         raise HTTPException(status_code=403, detail="You are not authorized to update this note")
 
-    event = Event(
-        aggregate_id=note_id,
-        user_id=user_id,
-        event_type="NoteUpdated",
-        timestamp=datetime.utcnow(),
-        data={"content": update.content}
-    )
-    publish_event(event.dict())
-    return {"message": "Note update requested."}
+    version = await write_event(note_id, user_id, "NoteUpdated", update.content, expected_version)
+    return {"version": version, "token": write_token(note_id, version), "message": "Note update requested."}
 
 @router.delete("/notes/{note_id}")
-def delete_note(note_id: str, user_id: str = Depends(get_user_from_token)):
-    events = get_events_for_aggregate(note_id)
-    if not events:
+async def delete_note(note_id: str, expected_version: Optional[int] = Query(None, ge=0),
+                      user_id: str = Depends(get_user_from_token)):
+    owner = await note_owner(note_id)
+    if owner is None:
         raise HTTPException(status_code=404, detail="Note not found")
 
     # Ensure the user is the owner of the note
-    if events[0]['user_id'] != user_id:
+    if owner != user_id:
         raise HTTPException(status_code=403, detail="You are not authorized to delete this note")
 
-    event = Event(
-        aggregate_id=note_id,
-        user_id=user_id,
-        event_type="NoteDeleted",
-        timestamp=datetime.utcnow(),
-        data={}
-    )
-    publish_event(event.dict())
-    return {"message": "Note delete requested."}
+    version = await write_event(note_id, user_id, "NoteDeleted", None, expected_version)
+    return {"version": version, "token": write_token(note_id, version), "message": "Note delete requested."}
 
 @router.get("/notes/{note_id}")
-def get_note(note_id: str, user_id: str = Depends(get_user_from_token)):
-    events = get_events_for_aggregate(note_id)
-    if not events:
+async def get_note(note_id: str, response: Response, min_version: Optional[str] = None,
+                   if_none_match: Optional[str] = Header(None), user_id: str = Depends(get_user_from_token)):
+    if min_version:
+        # Only the owner may hold a read open for a write
+        owner = await note_owner(note_id)
+        if owner is None:
+            raise HTTPException(status_code=404, detail="Note not found")
+        if owner != user_id:
+            raise HTTPException(status_code=403, detail="You are not authorized to view this note")
+    await wait_for_write(min_version, response, note_id)
+    note = await load_note(note_id)
+    if not note:
         raise HTTPException(status_code=404, detail="Note not found")
 
-    aggregate = NoteAggregate(note_id)
-    aggregate.load_from_events(events)
-
-    if aggregate.state.get("deleted"):
+    if note.get("deleted"):
         raise HTTPException(status_code=410, detail="Note was deleted")
 
-    if aggregate.state.get("user_id") != user_id:
+    if note.get("user_id") != user_id:
         raise HTTPException(status_code=403, detail="You are not authorized to view this note")
 
-    return aggregate.state
+    etag = make_etag(note_id, note["version"])
+    if not_modified(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return note_state(note)
 
 @router.get("/users/{user_id}/notes")
-def get_user_notes(user_id: str, current_user: str = Depends(get_user_from_token)):
+async def get_user_notes(user_id: str, response: Response, limit: Optional[int] = Query(None, ge=1),
+                         after: Optional[str] = None, fields: Optional[str] = None, view: Optional[str] = None,
+                         min_version: Optional[str] = None, if_none_match: Optional[str] = Header(None),
+                         current_user: str = Depends(get_user_from_token)):
+    """List a user's notes newest first. `fields` picks the returned fields, `view=summary` returns previews."""
     if user_id != current_user:
         raise HTTPException(status_code=403, detail="You are not authorized to access these notes")
-    note_ids = get_all_aggregates_for_user(user_id)
-    notes = []
-    for note_id in note_ids:
-        events = get_events_for_aggregate(note_id)
-        if not events:
-            continue
-        aggregate = NoteAggregate(note_id)
-        aggregate.load_from_events(events)
-        if not aggregate.state.get("deleted"):
-            notes.append({"note_id": note_id, **aggregate.state})
-    return notes
+    await wait_for_write(min_version, response)
+    try:
+        selected = parse_fields(fields, view)
+        notes, next_cursor = await load_user_notes(user_id, limit, after, selected)
+    except InvalidListing as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    # The page changes exactly when one of its notes gets a new version or the set of notes moves
+    etag = make_etag(selected, next_cursor, [(note["_id"], note["version"]) for note in notes])
+    headers = {"ETag": etag}
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if not_modified(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return [present(note, selected) for note in notes]
+
+def history_bound(value: str) -> dict:
+    """A history cursor is either a note version or an ISO timestamp."""
+    if value.isdigit():
+        return {"version": int(value)}
+    try:
+        return {"timestamp": datetime.fromisoformat(value)}
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid history cursor {value!r}")
+
+def history_query(note_id: str, after: Optional[str], before: Optional[str], event_types: Optional[List[str]]) -> dict:
+    # The version predicate lets the partial aggregate_version_unique index serve the sort by version
+    query = {"aggregate_id": note_id, "version": {"$gte": 1}}
+    if event_types:
+        query["event_type"] = {"$in": event_types}
+    for bound, operator in ((after, "$gt"), (before, "$lt")):
+        if bound:
+            for field, value in history_bound(bound).items():
+                query.setdefault(field, {})[operator] = value
+    return query
+
+def history_entry(event: dict) -> dict:
+    return {
+        "event_type": event["event_type"],
+        "timestamp": event["timestamp"],
+        "version": event.get("version"),
+        "data": event["data"]
+    }
+
+@router.get("/users/{user_id}/notes/changes")
+async def get_user_note_changes(user_id: str, current_user: str = Depends(get_user_from_token)):
+    """Server-sent events announcing each note of the user that changed, `resync` when some were dropped."""
+    if user_id != current_user:
+        raise HTTPException(status_code=403, detail="You are not authorized to access these notes")
+
+    async def stream():
+        queue = note_changes.subscribe(user_id)
+        try:
+            while True:
+                try:
+                    change = await asyncio.wait_for(queue.get(), CHANGES_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if change is None:
+                    yield "event: resync\ndata: {}\n\n"
+                    continue
+                change["token"] = write_token(change["note_id"], change["version"])
+                yield f"event: note\nid: {change['token']}\ndata: {json.dumps(change, default=str)}\n\n"
+        finally:
+            note_changes.unsubscribe(user_id, queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @router.get("/notes/{note_id}/history")
-def get_note_history(note_id: str):
-    events = get_events_for_aggregate(note_id)
-    if not events:
+async def get_note_history(note_id: str, response: Response, limit: Optional[int] = Query(None, ge=1),
+                           after: Optional[str] = None, before: Optional[str] = None,
+                           event_type: Optional[List[str]] = Query(None), output: str = Query("json", alias="format"),
+                           if_none_match: Optional[str] = Header(None), user_id: str = Depends(get_user_from_token)):
+    """Events of a note in version order. `after`/`before` take a version or a timestamp, `format=ndjson` streams."""
+    owner = await note_owner(note_id)
+    if owner is None:
         raise HTTPException(status_code=404, detail="Note not found")
-    history = []
-    for event in events:
-        history.append({
-            "event_type": event["event_type"],
-            "timestamp": event["timestamp"],
-            "data": event["data"]
-        })
+    if owner != user_id:
+        raise HTTPException(status_code=403, detail="You are not authorized to access this note")
+
+    if output != "ndjson":
+        # Events are never changed, a page only grows with new versions of the note
+        etag = make_etag(note_id, await current_version(note_id), limit, after, before, event_type)
+        if not_modified(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+
+    projection = {"_id": 0, "event_type": 1, "timestamp": 1, "version": 1, "data": 1}
+    cursor = events_collection.find(history_query(note_id, after, before, event_type), projection).sort("version")
+    if limit:
+        cursor = cursor.limit(limit)
+
+    if output == "ndjson":
+        async def stream():
+            async for event in cursor:
+                yield json.dumps(history_entry(event), default=str) + "\n"
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    with span("mongo read history"):
+        events = await cursor.to_list(length=None)
+    history = [history_entry(event) for event in events]
+    if limit and len(history) == limit:
+        last = history[-1]
+        response.headers["X-Next-Cursor"] = str(last["version"]) if last["version"] else last["timestamp"].isoformat()
     return {"note_id": note_id, "history": history}
 
+@router.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @router.get("/health")
-def health_check(response: Response):
+async def health_check(response: Response):
     response.status_code = 200
     return "OK"
@@ -0,0 +1,9 @@
+# auth_service writes blacklist entries and the gateway reads them, both must agree on these
+BLACKLIST_CHANNEL = "token_blacklist"
+
+
+def blacklist_key(token, payload):
+    """Redis key of a blacklisted token."""
+    # Tokens issued before jti was added are still blacklisted under the raw token
+    jti = payload.get("jti")
+    return f"blacklist:{jti}" if jti else token
@@ -0,0 +1,57 @@
+from difflib import SequenceMatcher
+
+# Above this many character comparisons the changed middle is stored as one replacement
+MAX_DIFF_WORK = 1_000_000
+
+
+def make_delta(old, new):
+    """Compact diff turning `old` into `new`.
+
+    A list of ["=", kept_length], ["-", removed_text] and ["+", inserted_text]
+    operations. Removed text is kept so a history view can show real diffs.
+    """
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    old_middle = old[prefix:len(old) - suffix]
+    new_middle = new[prefix:len(new) - suffix]
+
+    ops = []
+    if prefix:
+        ops.append(["=", prefix])
+    if len(old_middle) * len(new_middle) <= MAX_DIFF_WORK:
+        matcher = SequenceMatcher(None, old_middle, new_middle, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                ops.append(["=", i2 - i1])
+                continue
+            if i2 > i1:
+                ops.append(["-", old_middle[i1:i2]])
+            if j2 > j1:
+                ops.append(["+", new_middle[j1:j2]])
+    else:
+        if old_middle:
+            ops.append(["-", old_middle])
+        if new_middle:
+            ops.append(["+", new_middle])
+    if suffix:
+        ops.append(["=", suffix])
+    return ops
+
+
+def apply_delta(old, ops):
+    parts = []
+    position = 0
+    for op, value in ops:
+        if op == "=":
+            parts.append(old[position:position + value])
+            position += value
+        elif op == "-":
+            position += len(value)
+        else:
+            parts.append(value)
+    return "".join(parts)
@@ -0,0 +1,40 @@
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+
+class TokenVerifier:
+    """Verifies JWTs once and remembers the claims of tokens already verified.
+
+    The cache is a bounded LRU keyed by the token's signature. A hit is only
+    trusted for the exact same token and until its `exp` claim passes.
+    """
+
+    def __init__(self, secret, algorithms=("HS256",), size=10000):
+        self.secret = secret
+        self.algorithms = list(algorithms)
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def verify(self, token):
+        """Return the token claims, raising jwt.InvalidTokenError (or ExpiredSignatureError) like jwt.decode."""
+        signature = token.rpartition(".")[2]
+        with self._lock:
+            cached = self._cache.get(signature)
+            if cached is not None and cached[0] == token:
+                claims = cached[1]
+                if "exp" in claims and claims["exp"] <= time.time():
+                    del self._cache[signature]
+                    raise jwt.ExpiredSignatureError("Signature has expired")
+                self._cache.move_to_end(signature)
+                return claims
+
+        claims = jwt.decode(token, self.secret, algorithms=self.algorithms)
+        with self._lock:
+            self._cache[signature] = (token, claims)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return claims
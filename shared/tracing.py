@@ -0,0 +1,172 @@
+"""Request tracing and stage metrics shared by every service.
+
+Each process calls configure() with its service name once at start.
+"""
+import contextvars
+import json
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+import urllib.request
+
+from prometheus_client import Counter, Histogram
+
+INSTANCE = os.getenv("SERVICE_NAME", "")
+# Spans go to a JSON lines file, a Zipkin compatible collector (e.g. http://zipkin:9411/api/v2/spans), or nowhere
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL")
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 1))
+EXPORT_BATCH = 100
+EXPORT_INTERVAL = 1.0
+
+SPAN_SECONDS = Histogram("span_duration_seconds", "Time spent in each traced stage", ["span"])
+SPAN_ERRORS = Counter("span_errors_total", "Traced stages that raised", ["span"])
+
+_current = contextvars.ContextVar("current_span", default=None)
+_exports = queue.Queue(maxsize=10000)
+_service = None
+
+
+class Span:
+    """One timed stage of a request. Use as a context manager, nested spans become its children.
+
+    Every span is counted in the span_duration_seconds histogram. Sampled spans
+    are also exported, the sampling decision is taken at the root and travels
+    with the trace context.
+    """
+
+    def __init__(self, name, traceparent=None, **tags):
+        self.name = name
+        self.tags = tags
+        parent = parse_traceparent(traceparent) if traceparent else _current.get()
+        if parent is None:
+            self.trace_id, self.parent_id, self.sampled = secrets.token_hex(16), None, random.random() < SAMPLE_RATE
+        else:
+            self.trace_id, self.parent_id, self.sampled = parent.trace_id, parent.span_id, parent.sampled
+        self.span_id = secrets.token_hex(8)
+        self._token = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self._perf = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                # Finished from another context, e.g. a streamed response
+                pass
+        if exc is not None:
+            self.tags["error"] = repr(exc)
+            SPAN_ERRORS.labels(self.name).inc()
+        self.finish(time.perf_counter() - self._perf)
+        return False
+
+    def finish(self, duration):
+        SPAN_SECONDS.labels(self.name).observe(duration)
+        if self.sampled and _service is not None and (TRACE_FILE or TRACE_COLLECTOR_URL):
+            _export(self, duration)
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+class _Context:
+    def __init__(self, trace_id, span_id, sampled):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+
+def parse_traceparent(header):
+    """Trace context of a W3C traceparent header, None when it is malformed."""
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return _Context(parts[1], parts[2], parts[3] == "01")
+
+
+def span(name, traceparent=None, **tags):
+    return Span(name, traceparent, **tags)
+
+
+def record_span(name, traceparent, started, duration, **tags):
+    """Report a stage that was timed without a context manager, e.g. across a batch."""
+    finished = Span(name, traceparent, **tags)
+    finished.started = started
+    finished.finish(duration)
+
+
+def current_traceparent():
+    """traceparent header of the current span, to pass the trace on to another service."""
+    current = _current.get()
+    return current.traceparent if current is not None else None
+
+
+async def asgi_trace_middleware(request, call_next):
+    """Root span of every request of a FastAPI service, continuing the trace the caller sent in traceparent.
+
+    Register with app.middleware("http")(asgi_trace_middleware).
+    """
+    with span(f"{request.method} unmatched", request.headers.get("traceparent")) as root:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None:
+            # Named after the route template, not the path, to keep the metric labels bounded
+            root.name = f"{request.method} {route.path}"
+        root.tags["status"] = response.status_code
+    return response
+
+
+def _export(finished, duration):
+    record = {
+        "traceId": finished.trace_id,
+        "id": finished.span_id,
+        "name": finished.name,
+        "timestamp": int(finished.started * 1_000_000),
+        "duration": max(1, int(duration * 1_000_000)),
+        "localEndpoint": {"serviceName": _service},
+        "tags": {"instance": INSTANCE, **{key: str(value) for key, value in finished.tags.items()}},
+    }
+    if finished.parent_id:
+        record["parentId"] = finished.parent_id
+    try:
+        _exports.put_nowait(record)
+    except queue.Full:
+        pass
+
+
+def _run_exporter():
+    while True:
+        batch = [_exports.get()]
+        deadline = time.monotonic() + EXPORT_INTERVAL
+        while len(batch) < EXPORT_BATCH and time.monotonic() < deadline:
+            try:
+                batch.append(_exports.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            if TRACE_FILE:
+                with open(TRACE_FILE, "a") as out:
+                    out.writelines(json.dumps(record) + "\n" for record in batch)
+            if TRACE_COLLECTOR_URL:
+                request = urllib.request.Request(TRACE_COLLECTOR_URL, data=json.dumps(batch).encode(),
+                                                 headers={"Content-Type": "application/json"})
+                urllib.request.urlopen(request, timeout=5).close()
+        except OSError as exc:
+            print(f"Exporting {len(batch)} spans failed: {exc}")
+
+
+def configure(service):
+    """Name the spans of this process are exported under, and start exporting them."""
+    global _service
+    if _service is None:
+        threading.Thread(target=_run_exporter, daemon=True).start()
+    _service = service